@@ -17,6 +17,7 @@ import batch_size
 import image_path
 from sklearn.cluster import KMeans
 import deepdish as dd
+from patch_cache import PatchEncodingCache
 
 IMAGE_PATH=image_path.image_path
 DATA_PATH=IMAGE_PATH+'/patchs'
@@ -147,7 +148,7 @@ class ConvolutionalAutoencoder(object):
                     saver.save(sess, 'saver/cnn', global_step=step)
                     print('checkpoint saved')
 
-    def reconstruct(self):
+    def reconstruct(self, dedup=True, quant_step=1.0 / 255, encode_batch_size=1024):
 
         def weights_to_grid(weights, rows, cols):
             """convert the weights tensor into a grid for visualization"""
@@ -199,16 +200,15 @@ class ConvolutionalAutoencoder(object):
             training_images = dd.io.load(IMAGE_PATH + '/patchs/train_dataset_' + str(PATCH_SIZE) + '.h5')['patchs']
             images = np.transpose(training_images, (0, 2, 3, 1))
 
-            data_vec=[]
-
-            for i in range(images.shape[0]):
-                x=images[[i]]
-
-            # visualize encode
-                vec = sess.run((self.encoded), feed_dict={self.x: x})
-            #print(vec)
-                a=vec[0]
-                data_vec.append(vec[0])
+            # 只编码去重后的patch, 再按下标散射回每个像素
+            encode_fn = lambda x: sess.run(self.encoded, feed_dict={self.x: x})
+            if dedup:
+                cache = PatchEncodingCache(quant_step=quant_step, batch_size=encode_batch_size)
+                data_vec = cache.encode(images, encode_fn)
+                print(cache.report())
+            else:
+                data_vec = np.concatenate([encode_fn(images[i:i + encode_batch_size])
+                                           for i in range(0, images.shape[0], encode_batch_size)], axis=0)
 
             data_vec_dict={}
             #print(data_vec)
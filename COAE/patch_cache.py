@@ -0,0 +1,101 @@
+import numpy as np
+
+
+class PatchEncodingCache(object):
+    """
+    Content-deduplicating front end for the patch encoder.
+
+    Homogeneous regions (water, bare soil, SAR shadow) yield many identical
+    patches. Patches are quantised with `quant_step`, hashed to a 64-bit key,
+    only one representative per key is pushed through `encode_fn`, and the
+    codes are scattered back to every pixel. Every patch is checked against
+    its representative, so hash collisions never merge different content.
+    """
+    def __init__(self, quant_step=1.0 / 255, batch_size=1024, hash_chunk=65536, seed=0):
+        self.quant_step = quant_step
+        self.batch_size = batch_size
+        self.hash_chunk = hash_chunk
+        self.seed = seed
+        self._multipliers = None
+        self.lookups = 0
+        self.hits = 0
+        self.collisions = 0
+
+    def _get_multipliers(self, length):
+        if self._multipliers is None or self._multipliers.shape[0] != length:
+            # odd 64-bit multipliers so every quantised value contributes to the key
+            rng = np.random.RandomState(self.seed)
+            high = rng.randint(0, 2 ** 31, size=length).astype(np.uint64)
+            low = rng.randint(0, 2 ** 31, size=length).astype(np.uint64)
+            self._multipliers = (high << np.uint64(32)) | (low << np.uint64(1)) | np.uint64(1)
+        return self._multipliers
+
+    def _quantize(self, rows):
+        return np.rint(rows / self.quant_step).astype(np.int64)
+
+    def hash_patches(self, patches):
+        """
+        Return one uint64 key per patch of quantised content.
+        Hashing runs chunk by chunk so the int64 copy never exceeds `hash_chunk` patches.
+        """
+        num = patches.shape[0]
+        flat = patches.reshape(num, -1)
+        mult = self._get_multipliers(flat.shape[1])
+        keys = np.empty(num, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for start in range(0, num, self.hash_chunk):
+                q = self._quantize(flat[start:start + self.hash_chunk])
+                keys[start:start + self.hash_chunk] = q.view(np.uint64) @ mult  # wraps mod 2^64
+        return keys
+
+    def unique(self, patches):
+        """
+        Return (first, inverse): index of one representative per unique patch
+        and, for every patch, the row of its representative.
+        """
+        keys = self.hash_patches(patches)
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        # 校验: 每个 patch 的量化内容必须与其代表相同; 不同的 (哈希碰撞) 按量化内容精确分组
+        flat = patches.reshape(patches.shape[0], -1)
+        differs = np.zeros(flat.shape[0], dtype=bool)
+        for start in range(0, flat.shape[0], self.hash_chunk):
+            rows = slice(start, start + self.hash_chunk)
+            differs[rows] = (self._quantize(flat[rows]) != self._quantize(flat[first[inverse[rows]]])).any(axis=1)
+        if not differs.any():
+            return first, inverse
+        self.collisions += int(np.unique(inverse[differs]).shape[0])
+        members = np.nonzero(np.isin(inverse, inverse[differs]))[0]
+        _, exact = np.unique(self._quantize(flat[members]), axis=0, return_inverse=True)
+        labels = inverse.astype(np.int64)
+        labels[members] = first.shape[0] + exact.reshape(-1)
+        _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+        return first, inverse.reshape(-1)
+
+    def encode(self, patches, encode_fn):
+        """
+        patches: (M, H, W, C) array; encode_fn: batch (b, H, W, C) -> (b, D) codes.
+        Returns (M, D) codes, identical for patches that share a key.
+        """
+        first, inverse = self.unique(patches)
+        representatives = patches[first]
+
+        codes = []
+        for start in range(0, representatives.shape[0], self.batch_size):
+            codes.append(np.asarray(encode_fn(representatives[start:start + self.batch_size])))
+        codes = np.concatenate(codes, axis=0)
+
+        self.lookups += patches.shape[0]
+        self.hits += patches.shape[0] - first.shape[0]
+        return codes[inverse]
+
+    @property
+    def hit_rate(self):
+        if self.lookups == 0:
+            return 0.0
+        return float(self.hits) / self.lookups
+
+    def report(self):
+        return "dedup cache: {} patches, {} encoded, hit rate {:.2%}, {} hash collisions".format(
+            self.lookups, self.lookups - self.hits, self.hit_rate, self.collisions)
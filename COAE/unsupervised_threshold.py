@@ -0,0 +1,177 @@
+import numpy as np
+import cv2
+import os
+import scipy.io as io
+import patch_size
+import image_path
+import batch_size
+BATCH_SIZE=batch_size.batch_size
+
+IMAGE_PATH=image_path.image_path
+PATCH_SIZE=patch_size.patch_size
+
+# 无监督二值化: 不需要 im3.bmp, 直接在距离数组上求阈值, 一次生成最终变化图
+
+
+def otsu_from_histogram(counts, edges):
+    """
+    Otsu threshold of a histogram: the bin edge that maximises the between-class variance.
+    """
+    counts = counts.astype(np.float64)
+    if counts.sum() <= 0:
+        return edges[0]                 # 空直方图: 没有可分的两类
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    p = counts / counts.sum()
+    omega = np.cumsum(p)                # 背景类概率
+    mu = np.cumsum(p * centers)         # 背景类一阶累积矩
+    mu_t = mu[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_b = (mu_t * omega - mu) ** 2 / (omega * (1.0 - omega))
+    sigma_b[~np.isfinite(sigma_b)] = -1
+    return edges[np.argmax(sigma_b) + 1]
+
+
+def kmeans_from_histogram(counts, edges, max_iter=100, tol=1e-6):
+    """
+    2-cluster k-means on histogram bin centres weighted by their counts.
+    Returns the decision boundary between the two centres.
+    """
+    counts = counts.astype(np.float64)
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    nonzero = np.nonzero(counts)[0]
+    if nonzero.size == 0:
+        return edges[0]                 # 空直方图 (全 0 或没有 bin), 与 otsu_from_histogram 一致
+    c0, c1 = centers[nonzero[0]], centers[nonzero[-1]]
+    for _ in range(max_iter):
+        threshold = 0.5 * (c0 + c1)
+        low = centers < threshold
+        w_low, w_high = counts[low].sum(), counts[~low].sum()
+        if w_low == 0 or w_high == 0:
+            break
+        n0 = (counts[low] * centers[low]).sum() / w_low
+        n1 = (counts[~low] * centers[~low]).sum() / w_high
+        converged = abs(n0 - c0) < tol and abs(n1 - c1) < tol
+        c0, c1 = n0, n1
+        if converged:
+            break
+    return 0.5 * (c0 + c1)
+
+
+def otsu_threshold(dist, bins=256):
+    dist = np.asarray(dist, dtype=np.float64).ravel()
+    counts, edges = np.histogram(dist, bins=bins, range=(dist.min(), dist.max()))
+    return otsu_from_histogram(counts, edges)
+
+
+def kmeans_threshold(dist, bins=256, exact=False, max_iter=100, tol=1e-6):
+    """
+    2-cluster k-means threshold of the distances (unchanged / changed). By default the histogram is built
+    in a single pass over the data and k-means runs on it (kmeans_from_histogram), like otsu_threshold.
+    exact=True runs k-means on the raw distances instead, initialised at the minimum and maximum
+    distance; each of its up to max_iter iterations is another full pass over the data.
+    """
+    dist = np.asarray(dist, dtype=np.float64).ravel()
+    if not exact:
+        counts, edges = np.histogram(dist, bins=bins, range=(dist.min(), dist.max()))
+        return kmeans_from_histogram(counts, edges, max_iter=max_iter, tol=tol)
+    c0, c1 = dist.min(), dist.max()
+    total = dist.sum()
+    for _ in range(max_iter):
+        threshold = 0.5 * (c0 + c1)
+        high = dist >= threshold
+        n_high = np.count_nonzero(high)
+        if n_high == 0 or n_high == dist.size:
+            break
+        s_high = dist[high].sum()
+        n0 = (total - s_high) / (dist.size - n_high)
+        n1 = s_high / n_high
+        converged = abs(n0 - c0) < tol and abs(n1 - c1) < tol
+        c0, c1 = n0, n1
+        if converged:
+            break
+    return 0.5 * (c0 + c1)
+
+
+class StreamingHistogram(object):
+    """
+    Fixed-size histogram over [0, upper) for non-negative distances that arrive in chunks.
+    When a chunk exceeds the current range, the range is doubled and neighbouring bins
+    are merged, so the whole scene is histogrammed in one pass without knowing its maximum.
+    """
+    def __init__(self, bins=1024, upper=None):
+        assert bins % 2 == 0
+        self.bins = bins
+        self.upper = upper
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64).ravel()
+        if chunk.size == 0:
+            return self
+        assert chunk.min() >= 0, "distances must be non-negative"
+        top = chunk.max()
+        if self.upper is None:
+            self.upper = top * (1 + 1e-6) if top > 0 else 1.0
+        while top >= self.upper:
+            merged = self.counts.reshape(-1, 2).sum(axis=1)
+            self.counts = np.concatenate([merged, np.zeros(self.bins // 2, dtype=np.int64)])
+            self.upper *= 2
+        self.counts += np.histogram(chunk, bins=self.bins, range=(0, self.upper))[0]
+        return self
+
+    @property
+    def edges(self):
+        return np.linspace(0, self.upper or 1.0, self.bins + 1)     # 还没收到数据时 upper 为 None
+
+    def threshold(self, method='otsu'):
+        if method == 'otsu':
+            return otsu_from_histogram(self.counts, self.edges)
+        elif method == 'kmeans':
+            return kmeans_from_histogram(self.counts, self.edges)
+        raise ValueError("unknown threshold method: {}".format(method))
+
+
+def streaming_threshold(chunks, method='otsu', bins=1024):
+    hist = StreamingHistogram(bins=bins)
+    for chunk in chunks:
+        hist.update(chunk)
+    return hist.threshold(method)
+
+
+def change_map(dist, shape, threshold):
+    # dist < threshold -> 0 (未变化), 否则 -> 255 (变化), 与 caeae_dif.py 一致
+    dist = np.asarray(dist).reshape(shape[:2])
+    return np.where(dist < threshold, 0, 255).astype(np.uint8)
+
+
+def binarize(dist, shape, method='otsu', streaming=False, bins=256, chunk_size=1 << 20):
+    """
+    method: 'otsu' or 'kmeans'. streaming=True builds the histogram chunk by chunk
+    (StreamingHistogram) instead of holding a float64 copy of the whole scene.
+    """
+    if streaming:
+        flat = np.asarray(dist).ravel()
+        chunks = (flat[i:i + chunk_size] for i in range(0, flat.size, chunk_size))
+        threshold = streaming_threshold(chunks, method=method, bins=bins)
+    elif method == 'otsu':
+        threshold = otsu_threshold(dist, bins=bins)
+    elif method == 'kmeans':
+        threshold = kmeans_threshold(dist, bins=bins)
+    else:
+        raise ValueError("unknown threshold method: {}".format(method))
+    return change_map(dist, shape, threshold), threshold
+
+
+def main(method='otsu', streaming=False):
+    input_vecs = io.loadmat(IMAGE_PATH+'/patchs/data_vec_'+str(PATCH_SIZE)+'_training_1.mat')['vec']
+    recon_vecs = io.loadmat(IMAGE_PATH+'/patchs/data_vec_'+str(PATCH_SIZE)+'_training_2.mat')['vec']
+    dist = np.linalg.norm(input_vecs - recon_vecs, axis=1)
+
+    dif_image = cv2.imread(IMAGE_PATH+'/change_map_1_s_'+str(PATCH_SIZE)+'.bmp')
+    result, threshold = binarize(dist, dif_image.shape, method=method, streaming=streaming)
+    print("{} threshold: {:.5f}, changed pixels: {}".format(method, threshold, np.count_nonzero(result)))
+    cv2.imwrite(os.path.join(IMAGE_PATH,'caeae_'+method+'_b_'+str(BATCH_SIZE)+'_s_'+str(PATCH_SIZE)+'_t_'+'%.3f'%threshold+'.bmp'), result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,62 +1,97 @@
+import threading
+import collections
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-import transforms3d as t3d
 from torch.nn.modules.transformer import Transformer
+from torch.nn.modules.batchnorm import _BatchNorm
 from scipy.spatial.transform import Rotation
 from ops.transform_functions import PCRNetTransform as transform
 from ops import quaternion
+from ops import pose
+from ops.knn import knn_search
+from ops.graph import gather_neighbors, project_gather, project_gather_activated
+from ops.checkpointing import checkpointed
+from ops.packing import masked_max
+from ops.workspace import Workspace
 # torch.set_printoptions(threshold=float('inf'))
 
-def nearest_neighbor(src, dst):
-    inner = -2 * torch.matmul(src.transpose(1, 0).contiguous(), dst)  # src, dst (num_dims, num_points)
-    distances = -torch.sum(src ** 2, dim=0, keepdim=True).transpose(1, 0).contiguous() - inner - torch.sum(dst ** 2, dim=0, keepdim=True)
-    distances, indices = distances.topk(k=1, dim=-1)
-    return distances, indices
-
-def knn(x, k):  # x: data(B, 3, N)  k: neighbors_num
-    inner = -2 * torch.matmul(x.transpose(2, 1).contiguous(), x)    # (B, N, N)
-    xx = torch.sum(x ** 2, dim=1, keepdim=True)     # 对第1维求平方和, keepdim:求和之后这个dim的元素个数为１，所以要被去掉，如果要保留这个维度，则应当keepdim=True`
-    pairwise_distance = -xx - inner - xx.transpose(2, 1).contiguous()
-    idx = pairwise_distance.topk(k=k, dim=-1)[1]  # (batch_size, num_points, k)
+def nearest_neighbor(src, dst, backend='auto'):
+    # src, dst: (num_dims, num_points) -> distances: (N_src, 1) 负平方距离, indices: (N_src, 1)
+    distances, indices = knn_search(src.unsqueeze(0), dst.unsqueeze(0), k=1, backend=backend)
+    return -distances[0], indices[0]
+
+def knn(x, k, backend='auto', mask=None):  # x: data(B, 3, N)  k: neighbors_num
+    # 'dense' 与原实现一致: 构建 (B, N, N) 距离矩阵后 topk; 大点云由 'auto' 切换到 blockwise / kdtree
+    # mask: (B, N) 变长 batch 的有效点, 补齐的点不会成为邻居, 见 ops/packing.py
+    idx = knn_search(x, x, k=k, backend=backend, ref_mask=mask)[1]  # (batch_size, num_points, k)
     return idx
 
-def get_neighbors(data, k=20):
+def get_neighbors(data, k=20, backend='auto', idx=None, mask=None, workspace=None):
+    # workspace: ops/workspace.py 的 Workspace, 返回的 nbrs / idx 是其中的缓冲区 (只用于 no_grad 推理)
     # xyz = data[:, :3, :]    # (B, 3, N)
     xyz = data.view(*data.size()[:3])
-    idx = knn(xyz, k=k)  # (batch_size, num_points, k) 即: (B, N, n): 里面存的是N个点的n个邻居的下标
+    # idx: 预先计算好的邻居下标 (B, N, >=k), 见 PANet.forward
+    if idx is None:
+        idx = knn(xyz, k=k, backend=backend, mask=mask)
+    else:
+        idx = idx[:, :, :k]
+    # (batch_size, num_points, k) 即: (B, N, n): 里面存的是N个点的n个邻居的下标
     batch_size, num_points, _ = idx.size()
     # device = torch.device('cuda')
 
-    # idx_base: [B, 1, 1]
-    idx_base = torch.arange(0, batch_size).to(xyz.device).view(-1, 1, 1) * num_points   # arange不包含batch_size
-    nbrs = torch.tensor([]).to(xyz.device)
-
-    idx = idx + idx_base    # 每个点n近邻的下标    (B, N, n)
-    idx = idx.view(-1)  # idx: 0 ~ (batch_size * num_points -1)
-
     _, num_dims, _ = xyz.size()    # num_dims = 3
 
-    xyz = xyz.transpose(2, 1).contiguous()  # (batch_size, num_points, num_dims)
-
-    # gxyz
-    # (batch_size, num_points, num_dims)  -> (batch_size*num_points, num_dims)
-    #  batch_size * num_points * k + range(0, batch_size*num_points)
-    neighbor_gxyz = xyz.view(batch_size * num_points, -1)[idx, :]   # neighbor_gxyz.shape = (B*N*n, 3)
-    neighbor_gxyz = neighbor_gxyz.view(batch_size, num_points, k, num_dims)     # (B, N, n, 3)
-    # if 'gxyz' in feature_name:
-    #     net_input = torch.cat((net_input, neighbor_gxyz), dim=3)
+    # 直接按下标从 (B, 3, N) 中 gather 出 (B, 3, N, n), 不再经过 (B*N, 3) 的行索引, permute 和空张量 cat
+    out = None
+    if workspace is not None:
+        out = workspace.get('neighbors', (batch_size, num_dims, num_points, k), xyz.dtype, xyz.device)
+    nbrs = gather_neighbors(xyz, idx, out=out)
 
-    # # xyz
-    # xyz = xyz.view(batch_size, num_points, 1, num_dims).repeat(1, 1, k, 1)
-    # net_input = torch.cat((net_input, xyz), dim=3)
-
-    nbrs = torch.cat((nbrs, neighbor_gxyz), dim=3)
-    nbrs = nbrs.permute(0, 3, 1, 2).contiguous()
+    # idx_base: [B, 1, 1], 返回的下标与原实现相同: 加上 batch 偏移后展平, 0 ~ (batch_size * num_points -1)
+    if workspace is None:
+        idx = (idx + torch.arange(0, batch_size, device=xyz.device).view(-1, 1, 1) * num_points).view(-1)
+    else:
+        flat = workspace.get('neighbor_idx', (batch_size * num_points * k,), idx.dtype, idx.device)
+        idx = torch.add(idx, workspace.index_base(batch_size, num_points, idx.device),
+                        out=flat.view(batch_size, num_points, k)).view(-1)
 
     return nbrs, idx    # (B, 3, N, n)
 
+def _neighbor_max(lf, k=None):
+    # (B, C, N, >=k) -> 前 k 个邻居上的最大值 (B, C, N)
+    k = lf.shape[-1] if k is None else k
+    if lf.is_quantized:
+        # int8 激活 (quantize.py 的 static 模式) 的 max(dim) 没有快速实现, 用量化 max_pool2d;
+        # 步长为整行的 (1, k) 窗口只覆盖前 k 列, 不需要先切片 (切片会触发拷贝)
+        return F.max_pool2d(lf, (1, k), stride=(1, lf.shape[-1])).squeeze(-1)
+    return torch.amax(lf[:, :, :, :k], dim=-1)    # 与 max(dim)[0] 的值相同, 但不产生下标张量
+
+def _bn_affine(bn):
+    # eval 模式的 BatchNorm 是逐通道仿射: y = x * scale + shift
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.weight is not None:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.bias is not None:
+        shift = shift + bn.bias
+    return scale, shift
+
+def batch_norm_(x, bn, workspace=None, relu=False):
+    # no_grad 推理时原地计算 bn(x) (+ relu): x * scale + shift, scale / shift 缓存在 workspace 中, 与 bn(x) 相差 ~1e-6
+    # 没有 workspace, 训练模式, 没有 running stats 或 bn 不是 BatchNorm (例如 fold_batchnorm 后的 nn.Identity) 时就是 bn(x)
+    if workspace is None or not isinstance(bn, _BatchNorm) or bn.training or bn.running_var is None:
+        x = bn(x)
+        return F.relu(x, inplace=True) if relu else x
+    # load_state_dict / optimizer.step 原地修改参数会改变 _version, .to() 会改变 data_ptr
+    version = tuple((t.data_ptr(), t._version) for t in (bn.weight, bn.bias, bn.running_mean, bn.running_var)
+                    if t is not None)
+    scale, shift = workspace.memo(('batch_norm', id(bn)), version, lambda: _bn_affine(bn))
+    shape = (-1,) + (1,) * (x.dim() - 2)    # 通道维在 dim 1
+    x.mul_(scale.view(shape)).add_(shift.view(shape))
+    return x.relu_() if relu else x
+
 
 class ChannelAttention(nn.Module):
     def __init__(self, channel, reduction=4):
@@ -82,8 +117,8 @@ class ChannelAttention(nn.Module):
         b, c, _ = g.size()
 
         # a + b = 1
-        features = torch.cat((g.unsqueeze(dim=1), f.unsqueeze(dim=1)), dim=1)     # (B, 2, C, N)
-        features_U = torch.sum(features, dim=1)     # (B, C, N)
+        # 两个分支直接相加 / 加权, 不再拼成 (B, 2, C, N) 再求和
+        features_U = g + f     # (B, C, N)
         feat_pool = torch.mean(features_U, dim=-1)
         # feat_pool = torch.max(features_U, dim=-1)
         # feat_pool = self.avg_pool(features_U).view(b, c)    # (B, C, N) -> (B, C, 1) -> (B, C)
@@ -91,7 +126,7 @@ class ChannelAttention(nn.Module):
         beta = self.fc_2(feat_pool).view(b, 1, c)       # (B, C) -> (B, 1, C)
         matrix = torch.cat((alpha, beta), dim=1)   # (B, 2, C)
         matrix = F.softmax(matrix, dim=1).view(b, 2, c, 1)  # (B, 2, C) -> (B, 2, C, 1)
-        return (matrix * features).sum(dim=1)   # (B, C, N)
+        return g * matrix[:, 0] + f * matrix[:, 1]   # (B, C, N)
 
         # # a + b ≠ 1
         # features = torch.cat((g.unsqueeze(dim=1), f.unsqueeze(dim=1)), dim=1)     # (B, 2, C, N)
@@ -105,6 +140,7 @@ class ChannelAttention(nn.Module):
 class PointAttention(nn.Module):
     def __init__(self, channel, reduction=4):   # channel = 1024
         super(PointAttention, self).__init__()
+        self.channel = channel
         # 这里可以考虑将 64 -> 1 的卷积换成平均池化再过bn和relu
         self.fcn_1 = nn.Sequential(
             # nn.Conv1d(channel, channel // reduction, 1), nn.BatchNorm1d(channel // reduction), nn.ReLU(),
@@ -128,20 +164,39 @@ class PointAttention(nn.Module):
             nn.Conv1d(channel // reduction, 1, 1), nn.BatchNorm1d(1)
         )
 
+    @staticmethod
+    def _branch(fcn, x, workspace):
+        # no_grad 推理: fcn 中的 BN / ReLU 原地作用在前一个 conv 的输出上
+        if workspace is None:
+            return fcn(x)
+        for layer in fcn:
+            if isinstance(layer, _BatchNorm):
+                x = batch_norm_(x, layer, workspace)
+            elif isinstance(layer, nn.ReLU):
+                x = x.relu_()
+            else:
+                x = layer(x)
+        return x
+
     # 局部全局融合(或多个局部融合)
-    def forward(self, feature1, feature2):
-        feature1 = feature1.unsqueeze(dim=1)
-        feature2 = feature2.unsqueeze(dim=1)
-        features = torch.cat((feature1, feature2), dim=1) # (B, 2, C, N)
-        feature_U = torch.sum(features, dim=1)  # (B, C, N)
+    def forward(self, feature1, feature2, out=None, workspace=None):
+        # 两个分支直接相加 / 加权, 不再拼成 (B, 2, C, N) 再求和 (逐位相同: 两项求和就是一次加法)
+        # out: 可选的 (B, C, N) 输出缓冲区; workspace (no_grad): 提供 feature_U 和中间乘积的缓冲区
+        scratch = None if workspace is None else workspace.get('fuse_scratch', feature1.shape, feature1.dtype,
+                                                               feature1.device)
+        feature_U = torch.add(feature1, feature2, out=scratch) if scratch is not None else feature1 + feature2  # (B, C, N)
 
         # a + b = 1
-        a = self.fcn_1(feature_U)   # (B, 1, N)
-        b = self.fcn_2(feature_U)   # (B, 1, N)
+        a = self._branch(self.fcn_1, feature_U, workspace)   # (B, 1, N)
+        b = self._branch(self.fcn_2, feature_U, workspace)   # (B, 1, N)
         matrix = torch.cat((a, b), dim=1)   # (B, 2, N)
         matrix = F.softmax(matrix, dim=1)   # g -> a; f -> 1-a (B, 2, N)
         matrix = matrix.unsqueeze(dim=2)    # (B, 2, 1, N)
-        features = (matrix * features).sum(dim=1)  # (B, C, N): a * g + (1 - a) * f
+        if out is None:
+            features = feature1 * matrix[:, 0] + feature2 * matrix[:, 1]  # (B, C, N): a * g + (1 - a) * f
+        else:
+            features = torch.mul(feature1, matrix[:, 0], out=out)
+            features.add_(torch.mul(feature2, matrix[:, 1], out=scratch) if scratch is not None else feature2 * matrix[:, 1])
 
         # # a + b ≠ 1
         # a = F.softmax(self.fcn_1(feature_U), dim=1)
@@ -172,10 +227,21 @@ class PointAttention(nn.Module):
     #     return features
 
 class LAGNet(nn.Module):
-    def __init__(self, nbrs_num1=16, nbrs_num2=8):
+    def __init__(self, nbrs_num1=16, nbrs_num2=8, knn_backend='auto', share_branches=True, project_first=False,
+                 checkpoint_stages=False, use_workspace=True):
         super(LAGNet, self).__init__()
         self.nbrs_num1 = nbrs_num1
         self.nbrs_num2 = nbrs_num2
+        self.knn_backend = knn_backend    # 'auto' | 'dense' | 'blockwise' | 'kdtree', 见 ops/knn.py
+        # eval 时 m2 直接取 lf1 各阶段激活的前 n2 列, 省掉第二个分支 (训练时 BN 用 batch 统计量, 不能共享)
+        self.share_branches = share_branches
+        # 第一层 conv2d_1 无偏置: 先把每个点投影到 64 维再按 kNN 下标 gather, 等价但少 k 倍计算, 见 ops/graph.py
+        self.project_first = project_first
+        # 训练时对每个阶段做 activation checkpointing: 只保存阶段输入, 反向时重算 (B, C, N, k) 激活, 见 ops/checkpointing.py
+        self.checkpoint_stages = checkpoint_stages
+        # no_grad 推理时的中间结果写入按 (B, N, k, device, 线程) 缓存的 Workspace, 最多 WORKSPACE_CACHE 份
+        self.use_workspace = use_workspace
+        self._workspaces = collections.OrderedDict()
 
         self.pa_layer1 = PointAttention(channel=64, reduction=4)
         self.pa_layer2 = PointAttention(channel=64, reduction=4)
@@ -211,9 +277,68 @@ class LAGNet(nn.Module):
         # self.conv1d_6 = nn.Conv1d(1024, 1024, 1)
         # self.bn1d_6 = nn.BatchNorm1d(1024)
 
-    def forward(self, pointcloud):
-        pointcloud = pointcloud.permute(0, 2, 1).contiguous()   # (32, 3, 1024) 即:(B, 3, N)
-        batch_size, num_dims, N = pointcloud.size()
+    @staticmethod
+    def _activate(lf, conv, bn, workspace=None):
+        # conv 为 None: lf 已经投影过 (project_first); bn 也为 None: lf 已经是激活值
+        if conv is not None:
+            lf = conv(lf)
+        elif bn is not None:
+            workspace = None    # project_first 的 lf 可能与 lf2 共享存储, 不能原地归一化
+        if bn is not None:
+            lf = batch_norm_(lf, bn, workspace, relu=True)
+        return lf
+
+    WORKSPACE_CACHE = 8
+
+    def _workspace(self, batch_size, num_points, device):
+        if not self.use_workspace or torch.is_grad_enabled() or torch.jit.is_tracing() or torch.jit.is_scripting():
+            return None
+        workspaces = self.__dict__.setdefault('_workspaces', collections.OrderedDict())
+        key = (batch_size, num_points, self.nbrs_num1, device, threading.get_ident())
+        workspace = workspaces.pop(key, None)
+        if workspace is None:
+            workspace = Workspace()
+        workspaces[key] = workspace     # 移到末尾, 淘汰最久未用的
+        while len(workspaces) > self.WORKSPACE_CACHE:
+            workspaces.popitem(last=False)
+        return workspace
+
+    def _stage(self, lf1, lf2, conv, bn, pa_layer, out=None, workspace=None):
+        # out / workspace: 只在 no_grad 推理时给出, 见 forward
+        lf1 = self._activate(lf1, conv, bn, workspace)     # (B, C, N, n1)
+        if workspace is not None:
+            # amax 不产生 max 的下标张量, 结果写入缓冲区
+            B, C, N, _ = lf1.shape
+            m1 = torch.amax(lf1, dim=-1, out=workspace.get('max_1', (B, C, N), lf1.dtype, lf1.device))
+            m2 = workspace.get('max_2', (B, C, N), lf1.dtype, lf1.device)
+            if lf2 is None:
+                torch.amax(lf1[:, :, :, :self.nbrs_num2], dim=-1, out=m2)
+            else:
+                lf2 = self._activate(lf2, conv, bn, workspace)
+                torch.amax(lf2, dim=-1, out=m2)
+            return lf1, lf2, pa_layer(m1, m2, out=out, workspace=workspace)
+        m1 = _neighbor_max(lf1)     # (B, C, N)
+        if lf2 is None:
+            # 1x1 conv + BN(running stats) + ReLU 都是逐点运算, lf2 的激活恰好是 lf1 激活的前 n2 列
+            m2 = _neighbor_max(lf1, self.nbrs_num2)
+        else:
+            lf2 = self._activate(lf2, conv, bn)     # (B, C, N, n2)
+            m2 = _neighbor_max(lf2)     # (B, C, N)
+        return lf1, lf2, pa_layer(m1, m2)
+
+    def neighbor_graph(self, pointcloud, mask=None):
+        # pointcloud: (B, N, 3) -> idx: (B, N, n1)
+        return knn(pointcloud.permute(0, 2, 1).contiguous(), k=self.nbrs_num1, backend=self.knn_backend, mask=mask)
+
+    def forward(self, pointcloud, idx=None, mask=None):
+        # mask: (B, N) 变长 batch 的有效点, 只影响 kNN; 其余运算都是逐点的, 见 ops/packing.py
+        batch_size, N, num_dims = pointcloud.size()
+        workspace = self._workspace(batch_size, N, pointcloud.device)
+        if workspace is None:
+            pointcloud = pointcloud.permute(0, 2, 1).contiguous()   # (32, 3, 1024) 即:(B, 3, N)
+        else:
+            pointcloud = workspace.get('points', (batch_size, num_dims, N), pointcloud.dtype,
+                                       pointcloud.device).copy_(pointcloud.permute(0, 2, 1))
 
         # # 全局局部融合(lf + gf)
         # lf, idx_lf = get_neighbors(pointcloud, k=self.nbrs_num1)
@@ -252,35 +377,47 @@ class LAGNet(nn.Module):
 
 
         # 仅局部多尺度融合
-        lf1, idx_lf1 = get_neighbors(pointcloud, k=self.nbrs_num1)  # (B, 3, N, n1)
-        lf2 = lf1[:, :, :, :self.nbrs_num2]
-
-        lf1 = F.relu(self.bn2d_1(self.conv2d_1(lf1)), inplace=True)     # (B, C, N, n1)
-        lf2 = F.relu(self.bn2d_1(self.conv2d_1(lf2)), inplace=True)     # (B, C, N, n2)
-        m1 = lf1.max(dim=-1, keepdim=False)[0]     # (B, C, N)
-        m2 = lf2.max(dim=-1, keepdim=False)[0]     # (B, C, N)
-        fuse_1 = self.pa_layer1(m1, m2)
-
-        lf1 = F.relu(self.bn2d_2(self.conv2d_2(lf1)), inplace=True)
-        lf2 = F.relu(self.bn2d_2(self.conv2d_2(lf2)), inplace=True)
-        m1 = lf1.max(dim=-1, keepdim=False)[0]
-        m2 = lf2.max(dim=-1, keepdim=False)[0]
-        fuse_2 = self.pa_layer2(m1, m2)
-
-        lf1 = F.relu(self.bn2d_3(self.conv2d_3(lf1)), inplace=True)
-        lf2 = F.relu(self.bn2d_3(self.conv2d_3(lf2)), inplace=True)
-        m1 = lf1.max(dim=-1, keepdim=False)[0]
-        m2 = lf2.max(dim=-1, keepdim=False)[0]
-        fuse_3 = self.pa_layer3(m1, m2)
-
-        lf1 = F.relu(self.bn2d_4(self.conv2d_4(lf1)), inplace=True)
-        lf2 = F.relu(self.bn2d_4(self.conv2d_4(lf2)), inplace=True)
-        m1 = lf1.max(dim=-1, keepdim=False)[0]
-        m2 = lf2.max(dim=-1, keepdim=False)[0]
-        fuse_4 = self.pa_layer4(m1, m2)
-        features_cat = torch.cat((fuse_1, fuse_2, fuse_3, fuse_4), dim=1)
+        conv_1, bn_1 = self.conv2d_1, self.bn2d_1
+        if self.project_first:
+            if idx is None:
+                idx = knn(pointcloud, k=self.nbrs_num1, backend=self.knn_backend, mask=mask)
+            idx = idx[:, :, :self.nbrs_num1]
+            if self.training:
+                lf1 = project_gather(pointcloud, self.conv2d_1, idx)  # (B, 64, N, n1), 之后再过 BN + ReLU
+                conv_1 = None
+            else:
+                # eval: BN + ReLU 也是逐点的, 每个点只算一次再 gather
+                lf1 = project_gather_activated(pointcloud, self.conv2d_1, self.bn2d_1, idx)  # (B, 64, N, n1)
+                conv_1, bn_1 = None, None
+        else:
+            lf1, idx_lf1 = get_neighbors(pointcloud, k=self.nbrs_num1, backend=self.knn_backend, idx=idx, mask=mask,
+                                         workspace=workspace)  # (B, 3, N, n1)
+        # eval 模式下 lf2 分支与 lf1 共享计算, 见 _stage
+        share = self.share_branches and not self.training
+        lf2 = None if share else lf1[:, :, :, :self.nbrs_num2]
+
+        stage = self._stage
+        if self.checkpoint_stages and self.training and torch.is_grad_enabled():
+            stage = lambda *args: checkpointed(self._stage, self, *args)
+        stages = ((conv_1, bn_1, self.pa_layer1), (self.conv2d_2, self.bn2d_2, self.pa_layer2),
+                  (self.conv2d_3, self.bn2d_3, self.pa_layer3), (self.conv2d_4, self.bn2d_4, self.pa_layer4))
+        if workspace is None:
+            fuses = []
+            for conv, bn, pa_layer in stages:
+                lf1, lf2, fuse = stage(lf1, lf2, conv, bn, pa_layer)
+                fuses.append(fuse)
+            features_cat = torch.cat(fuses, dim=1)
+        else:
+            # 各阶段的融合结果直接写入 features_cat 的对应通道
+            channels = [pa_layer.channel for _, _, pa_layer in stages]
+            features_cat = workspace.get('features_cat', (batch_size, sum(channels), N), pointcloud.dtype,
+                                         pointcloud.device)
+            start = 0
+            for (conv, bn, pa_layer), C in zip(stages, channels):
+                lf1, lf2, _ = stage(lf1, lf2, conv, bn, pa_layer, features_cat[:, start:start + C], workspace)
+                start += C
 
-        pointcloud_features = F.relu(self.bn1d_5(self.conv1d_5(features_cat)), inplace=True)
+        pointcloud_features = batch_norm_(self.conv1d_5(features_cat), self.bn1d_5, workspace, relu=True)
 
 
         # # 全局加局部多尺度融合(lf1 + lf2 + gf)
@@ -327,9 +464,11 @@ class LAGNet(nn.Module):
 
 
 class PANet(nn.Module):
-    def __init__(self, source_feature_size=512, template_feature_size=512, feature_model=LAGNet()):
+    def __init__(self, source_feature_size=512, template_feature_size=512, feature_model=LAGNet(), checkpoint_iters=False):
         super(PANet, self).__init__()
         self.feature_model = feature_model
+        # 训练时对每次 refinement 迭代 (template 编码 + FC 回归) 做 activation checkpointing
+        self.checkpoint_iters = checkpoint_iters
         input_size = source_feature_size + template_feature_size
         self.fc = nn.Sequential(nn.Linear(input_size, 1024), nn.ReLU(),
                                 # nn.Linear(1024, 1024), nn.ReLU(),
@@ -341,84 +480,113 @@ class PANet(nn.Module):
 
     @staticmethod
     def quaternion_rotate(point_cloud: torch.Tensor, pose_7d: torch.Tensor):
-        ndim = point_cloud.dim()    # 判断输入数据是几维的, 若是(N, C)则ndim=2, 若是(B, N, C)则ndim=3
-        # 生成真实值
-        if ndim == 2:
-            N, _ = point_cloud.shape
-            assert pose_7d.shape[0] == 1
-            # repeat transformation vector for each point in shape
-            quat = pose_7d[:, :4].expand([N, -1])  # (N, 4)
-            rotated_point_cloud = quaternion.qrot(quat, point_cloud)
-
-        # 生成预测值
-        elif ndim == 3:
-            B, N, _ = point_cloud.shape
-            quat = pose_7d[:, :4].unsqueeze(1).expand([-1, N, -1]).contiguous()    # (B, N, 4)
-            rotated_point_cloud = quaternion.qrot(quat, point_cloud)
-        else:
+        # point_cloud: (N, C) 配合 (1, 7) 的 pose, 或 (B, N, C) 配合 (B, 7)
+        if point_cloud.dim() not in (2, 3):
             raise ValueError("quaternion_rotate dims error")
-
-        return rotated_point_cloud
+        return pose.rotate_points(pose_7d, point_cloud)
 
     @staticmethod
     def parameter_update(pose_pred_new, pose_pred_old):
-        pose_quat = quaternion.qmul(pose_pred_new[:, :4], pose_pred_old[:, :4])         # (B, 4)
-        pose_trans = quaternion.qrot(pose_pred_new[:, :4], pose_pred_old[:, 4:]) + pose_pred_new[:, 4:] # (B, 3)
-        pose_pred = torch.cat([pose_quat, pose_trans], dim=1)
-        return pose_pred
+        return pose.compose(pose_pred_new, pose_pred_old)
 
     @staticmethod
     def create_pose_7d(vector: torch.Tensor):
-        # Normalize the quaternion.
-        pre_normalized_quaternion = vector[:, 0:4]
-        normalized_quaternion = F.normalize(pre_normalized_quaternion, dim=1)
-
-        # B x 7 vector of 4 quaternions and 3 translation parameters
-        translation = vector[:, 4:]
-        vector = torch.cat([normalized_quaternion, translation], dim=1)
-        return vector.view([-1, 7])
+        # Normalize the quaternion. B x 7 vector of 4 quaternions and 3 translation parameters
+        return pose.normalize_pose(vector)
+
+    def encode(self, pointcloud, graph=None, mask=None):
+        # (B, N, 3) -> (B, 512) 全局特征; graph: 预先算好的 kNN 图, 见 LAGNet.neighbor_graph
+        # mask: (B, N) 变长 batch 的有效点, max pooling 只在有效点上进行
+        if mask is None:
+            features = self.feature_model(pointcloud, graph)    # (B, 512, N)
+            return torch.max(features, dim=2)[0].contiguous()
+        features = self.feature_model(pointcloud, graph, mask)
+        return masked_max(features, mask, dim=2).contiguous()
+
+    def regress(self, template_features, source_features):
+        # 由两个全局特征回归 (B, 7) 增量位姿, 四元数已归一化
+        fc_input = torch.cat((template_features, source_features), dim=1)
+        return self.create_pose_7d(self.fc(fc_input))
+
+    def _iteration(self, template, graph, source_features, mask=None):
+        return self.regress(self.encode(template, graph, mask), source_features)
 
     # source & template: (32, 1024, 3)
-    def forward(self, source, template, num_iter=4):    # template -> source
+    def forward(self, source, template, num_iter=4, rot_tol=None, trans_tol=None, init_pose=None,
+                source_mask=None, template_mask=None):    # template -> source
+        # rot_tol (弧度) / trans_tol: 增量位姿低于阈值的样本提前退出, 不再参与后续迭代 (eval 模式下使用)
+        # init_pose: (B, 7) 初始位姿 (例如金字塔配准中上一层的结果), 默认为单位位姿
+        # source_mask / template_mask: (B, N) 变长点云补齐后的有效点 (ops/packing.py 的 pad_clouds),
+        # 补齐的点不参与 kNN 和 max pooling; transformed_template 中补齐位置的值无意义
         # init params
         B, src_N, _ = source.size()
         _, ref_N, _ = template.size()
-        init_quat = t3d.euler.euler2quat(0., 0., 0., "sxyz")
-        init_quat = torch.from_numpy(init_quat).expand(B, 4).to(source.device)
-        init_translate = torch.from_numpy(np.array([[0., 0., 0.]])).expand(B, 3).to(source.device)
-        pose_pred = torch.cat((init_quat, init_translate), dim=1).float().to(source.device)  # (B, 7)
-
-        # rename template
-        template_iter = template.clone().to(template.device)
-        source_features = self.feature_model(source)    # (B, 1024, N)
-        source_features = torch.max(source_features, dim=2)[0].contiguous()
-
-        for i in range(num_iter):
-            template_features = self.feature_model(template_iter)  # (B, 1024, N)
-            template_features = torch.max(template_features, dim=2)[0].contiguous()
-
-            fc_input = torch.cat((template_features, source_features), dim=1)
-            pose_pred_iter = self.fc(fc_input)  # (B, 7)
-            pose_pred_iter = self.create_pose_7d(pose_pred_iter)    # 对输出(四元数)归一化
+        if init_pose is None:
+            pose_pred = pose.identity_pose(B, device=source.device, dtype=source.dtype)  # (B, 7): [1, 0, 0, 0, 0, 0, 0]
+            # rename template
+            template_iter = template.clone().to(template.device)
+        else:
+            pose_pred = init_pose.to(source)
+            template_iter = pose.transform_points(pose_pred, template)
+        source_features = self.encode(source, mask=source_mask)    # (B, 512)
 
-            template_iter = self.quaternion_rotate(template_iter, pose_pred_iter) + pose_pred_iter[:, 4:].unsqueeze(dim=1)   # Pt" = R*Pt + t
-            pose_pred = self.parameter_update(pose_pred_iter, pose_pred)
+        # template_iter 只做刚体变换, 邻居关系不变: kNN 图只算一次, 每次迭代复用
+        if template_mask is None:
+            template_graph = self.feature_model.neighbor_graph(template)
+        else:
+            template_graph = self.feature_model.neighbor_graph(template, template_mask)
 
-            pred_rot = torch.tensor([]).to(source.device)
+        adaptive = rot_tol is not None or trans_tol is not None
+        num_iters = torch.zeros(B, dtype=torch.long, device=source.device)     # 每个样本实际迭代次数
+        active = None   # None: 所有样本都在迭代; 否则为尚未收敛样本的下标
 
-            for i in range(B):
-                tmp = self.quaternion_rotate(torch.eye(3).to(source.device), pose_pred[i:i+1, :]).permute(1, 0)
-                pred_rot = torch.cat([pred_rot, tmp.unsqueeze(dim=0)], dim=0)
-            transform_pred = torch.cat([pred_rot, pose_pred[:, 4:].unsqueeze(dim=1).permute(0, 2, 1)], dim=2)  # (B, 3, 4)
+        for i in range(num_iter):
+            if active is None:
+                t_iter, t_graph, s_features, p_pred = template_iter, template_graph, source_features, pose_pred
+                t_mask = template_mask
+            else:
+                t_iter, t_graph, s_features, p_pred = template_iter[active], template_graph[active], source_features[active], pose_pred[active]
+                t_mask = None if template_mask is None else template_mask[active]
+
+            if self.checkpoint_iters and self.training and torch.is_grad_enabled():
+                pose_pred_iter = checkpointed(self._iteration, self.feature_model, t_iter, t_graph, s_features, t_mask)
+            else:
+                template_features = self.encode(t_iter, t_graph, t_mask)  # (B, 512)
+                pose_pred_iter = self.regress(template_features, s_features)    # (B, 7), 四元数已归一化
+
+            t_iter = pose.transform_points(pose_pred_iter, t_iter)   # Pt" = R*Pt + t
+            p_pred = self.parameter_update(pose_pred_iter, p_pred)
+
+            if active is None:
+                template_iter, pose_pred = t_iter, p_pred
+                num_iters += 1
+            else:
+                template_iter = template_iter.index_copy(0, active, t_iter)
+                pose_pred = pose_pred.index_copy(0, active, p_pred)
+                num_iters[active] += 1
+
+            if adaptive:
+                converged = torch.ones(pose_pred_iter.shape[0], dtype=torch.bool, device=source.device)
+                if rot_tol is not None:
+                    converged &= pose.rotation_angle(pose_pred_iter) < rot_tol
+                if trans_tol is not None:
+                    converged &= pose_pred_iter[:, 4:].norm(dim=1) < trans_tol
+                if active is None:
+                    active = torch.arange(B, device=source.device)
+                active = active[~converged]
+                if active.numel() == 0:
+                    break
+
+        transform_pred = pose.pose_to_transform(pose_pred)  # (B, 3, 4)
 
         result = {'pose_pred': pose_pred,               # (B, 7)
                   'transform_pred': transform_pred,     # (B, 3, 4)
-                  'transformed_template': template_iter
+                  'transformed_template': template_iter,
+                  'num_iters': num_iters                # (B,)
                   }
         return result
 
 if __name__ == '__main__':
-    source, template = torch.rand(10, 1024, 3), torch.rand(10, 1024, 3)
-    net = PANet()
-    result = net(source, template)
-    import ipdb; ipdb.set_trace()
+    # 端到端延迟 / 吞吐 / 峰值内存见 benchmark.py (命令行参数相同)
+    import benchmark
+    benchmark.main()
@@ -0,0 +1,257 @@
+import os
+import gc
+import sys
+import ctypes
+import json
+import time
+import argparse
+import platform
+import itertools
+import threading
+import subprocess
+import numpy as np
+import torch
+from PANet import PANet, LAGNet
+from ops.transform_functions import PCRNetTransform
+from ops.profiler import ModuleProfiler, count_allocations
+
+# PANet 端到端基准: 在合成点云上扫描 batch size / 点数 / num_iter / k,
+# 输出每个配置的 p50/p99 延迟, pairs/s 和峰值内存, 并可写成 JSON 与旧版本结果对比.
+#   python benchmark.py --batch_sizes 1 8 --num_points 1024 4096 --json new.json
+#   python benchmark.py --compare old.json new.json
+#   python benchmark.py --train --checkpoint none stages iters both    # 训练显存 / 吞吐权衡
+#   python benchmark.py --batch_sizes 8 --profile traces/     # 逐模块耗时表 + Chrome trace, 见 ops/profiler.py
+
+CONFIG_KEYS = ('batch_size', 'num_points', 'num_iter', 'k', 'train', 'checkpoint')
+CHECKPOINT_MODES = {'none': (False, False), 'stages': (True, False), 'iters': (False, True), 'both': (True, True)}
+
+
+class PeakMemory:
+    """
+    Peak memory of one measured region above the memory in use when it starts, in MB.
+    CUDA: torch.cuda.max_memory_allocated - memory_allocated at entry. CPU: a background thread samples
+    the resident set size from /proc/self/statm (Linux) and reports the peak minus the RSS at entry;
+    elsewhere the peak is reported as None.
+    """
+    def __init__(self, device, interval=0.001):
+        self.device = device
+        self.interval = interval
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self.statm = '/proc/self/statm' if os.path.exists('/proc/self/statm') else None
+
+    def _rss(self):
+        with open(self.statm) as f:
+            return int(f.read().split()[1]) * self.page_size
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _trim():
+        # 进程 RSS 很少回落 (分配器保留已释放的内存), 先把空闲内存还给系统, 起点才是当前真正在用的内存
+        try:
+            ctypes.CDLL('libc.so.6').malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+    def __enter__(self):
+        self.peak_mb = None
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.start = torch.cuda.memory_allocated(self.device)
+        elif self.statm is not None:
+            gc.collect()
+            self._trim()
+            self.start = self.peak = self._rss()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak_mb = (torch.cuda.max_memory_allocated(self.device) - self.start) / 2 ** 20
+        elif self.statm is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak_mb = (max(self.peak, self._rss()) - self.start) / 2 ** 20
+        return False
+
+
+def synthetic_pair(batch_size, num_points, device, seed=0):
+    # 单位立方体内的随机点云, source 由 PCRNetTransform 的随机刚体变换得到
+    generator = torch.Generator().manual_seed(seed)
+    template = torch.rand(batch_size, num_points, 3, generator=generator) - 0.5
+    bank = PCRNetTransform(batch_size, rng=seed)
+    source = bank(template, torch.arange(batch_size))[0]
+    return source.to(device), template.to(device)
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _train_step(model, source, template, num_iter):
+    # 一次前向 + 反向, 损失为变换后的 template 与 source 的 MSE
+    result = model(source, template, num_iter=num_iter)
+    loss = torch.nn.functional.mse_loss(result['transformed_template'], source)
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+
+
+def run_config(batch_size, num_points, num_iter, k, args, device, checkpoint='none'):
+    checkpoint_stages, checkpoint_iters = CHECKPOINT_MODES[checkpoint]
+    latencies = []
+    # 峰值内存从本配置开始 (建模型之前) 算起, 不受之前更大配置留下的 RSS 影响
+    with PeakMemory(device) as mem:
+        model = PANet(feature_model=LAGNet(nbrs_num1=k, nbrs_num2=max(1, k // 2), knn_backend=args.knn_backend,
+                                           checkpoint_stages=checkpoint_stages),
+                      checkpoint_iters=checkpoint_iters).to(device).train(args.train)
+        source, template = synthetic_pair(batch_size, num_points, device, seed=args.seed)
+        if args.train:
+            step = lambda: _train_step(model, source, template, num_iter)
+            grad = torch.enable_grad
+        else:
+            step = lambda: model(source, template, num_iter=num_iter)
+            grad = torch.no_grad
+        with grad():
+            for _ in range(args.warmup):
+                step()
+            _sync(device)
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                step()
+                _sync(device)
+                latencies.append(time.perf_counter() - start)
+    if args.profile is not None:
+        with grad():
+            # 计时结束后再单独跑一次带 hook 的 step, 不影响上面的延迟统计
+            with ModuleProfiler(model) as prof:
+                step()
+            name = 'B{}_N{}_it{}_k{}_{}{}'.format(batch_size, num_points, num_iter, k,
+                                                 'train_' if args.train else '', checkpoint)
+            print("== profile {}".format(name))
+            prof.print_table(limit=20)
+            _, allocs = count_allocations(step)
+            print("allocator calls per step: {} ({:.1f} MB)".format(allocs['allocations'], allocs['alloc_bytes'] / 2 ** 20))
+            os.makedirs(args.profile, exist_ok=True)
+            prof.export_chrome_trace(os.path.join(args.profile, 'trace_{}.json'.format(name)))
+    latencies = np.array(latencies) * 1e3
+    return {'batch_size': batch_size, 'num_points': num_points, 'num_iter': num_iter, 'k': k,
+            'train': args.train, 'checkpoint': checkpoint,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'mean_ms': float(latencies.mean()),
+            'pairs_per_s': float(batch_size / latencies.mean() * 1e3),
+            'peak_mem_mb': mem.peak_mb}
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format_mem(mb):
+    return '-' if mb is None else '{:.0f}'.format(mb)
+
+
+def print_results(results, header=True):
+    if header:
+        print("{:>6} {:>8} {:>5} {:>4} {:>7} {:>10} {:>10} {:>10} {:>10}".format(
+            'B', 'N', 'iter', 'k', 'ckpt', 'p50(ms)', 'p99(ms)', 'pairs/s', 'peak(MB)'))
+    for r in results:
+        if 'error' in r:
+            print("{:>6} {:>8} {:>5} {:>4} {:>7}  {}".format(r['batch_size'], r['num_points'], r['num_iter'], r['k'],
+                                                            r['checkpoint'], r['error']))
+            continue
+        print("{:>6} {:>8} {:>5} {:>4} {:>7} {:>10.2f} {:>10.2f} {:>10.1f} {:>10}".format(
+            r['batch_size'], r['num_points'], r['num_iter'], r['k'], r['checkpoint'],
+            r['p50_ms'], r['p99_ms'], r['pairs_per_s'], _format_mem(r['peak_mem_mb'])))
+
+
+def _config_key(r):
+    # 旧版本的结果文件没有 train / checkpoint 字段
+    defaults = {'train': False, 'checkpoint': 'none'}
+    return tuple(r.get(k, defaults.get(k)) for k in CONFIG_KEYS)
+
+
+def compare(old_path, new_path):
+    # 按 (B, N, num_iter, k) 对齐两次结果, 比值 > 1 表示新版本更快 / 更省内存
+    with open(old_path) as f:
+        old = {_config_key(r): r for r in json.load(f)['results'] if 'error' not in r}
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print("{:>6} {:>8} {:>5} {:>4} {:>12} {:>12} {:>12} {:>12}".format(
+        'B', 'N', 'iter', 'k', 'p50 speedup', 'p99 speedup', 'throughput', 'mem ratio'))
+    for r in new:
+        key = _config_key(r)
+        if key not in old or 'error' in r:
+            continue
+        o = old[key]
+        mem = '-'
+        if o['peak_mem_mb'] and r['peak_mem_mb']:
+            mem = '{:.2f}x'.format(o['peak_mem_mb'] / r['peak_mem_mb'])
+        print("{:>6} {:>8} {:>5} {:>4} {:>11.2f}x {:>11.2f}x {:>11.2f}x {:>12}".format(
+            *key[:4], o['p50_ms'] / r['p50_ms'], o['p99_ms'] / r['p99_ms'], r['pairs_per_s'] / o['pairs_per_s'], mem))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--num_points', type=int, nargs='+', default=[1024, 4096])
+    parser.add_argument('--num_iters', type=int, nargs='+', default=[4])
+    parser.add_argument('--k', type=int, nargs='+', default=[16])
+    parser.add_argument('--train', action='store_true', help='time forward + backward in training mode')
+    parser.add_argument('--checkpoint', nargs='+', default=['none'], choices=sorted(CHECKPOINT_MODES),
+                        help='activation checkpointing: LAGNet stages, PANet iterations or both (training only)')
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help='profile one extra step per config: print a per-module table and write a Chrome trace to DIR')
+    parser.add_argument('--knn_backend', default='auto', choices=('auto', 'dense', 'blockwise', 'kdtree'))
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+
+    results = []
+    for B, N, num_iter, k, ckpt in itertools.product(args.batch_sizes, args.num_points, args.num_iters, args.k,
+                                                     args.checkpoint):
+        try:
+            results.append(run_config(B, N, num_iter, k, args, device, ckpt))
+        except RuntimeError as e:   # 通常是大点数下内存不足, 记录下来继续扫描
+            results.append({'batch_size': B, 'num_points': N, 'num_iter': num_iter, 'k': k,
+                            'train': args.train, 'checkpoint': ckpt, 'error': str(e).splitlines()[0]})
+        print_results(results[-1:], header=len(results) == 1)
+        sys.stdout.flush()
+
+    if args.json:
+        meta = {'git': _git_revision(), 'torch': torch.__version__, 'python': platform.python_version(),
+                'platform': platform.platform(), 'processor': platform.processor(),
+                'threads': torch.get_num_threads(), 'device': str(device), 'knn_backend': args.knn_backend,
+                'warmup': args.warmup, 'repeat': args.repeat}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.dataloader import default_collate
+from ops.transform_functions import PCRNetTransform, farthest_subsample_points, jitter_pointcloud, add_outliers
+from ops.augment import AugmentCollate, partial_registration_pipeline
+from ops.cloud_io import write_pack, PackedClouds
+
+# 数据增强吞吐量: 原来逐样本的增强 + default_collate vs ops/augment.py 在 collate 中整 batch 增强
+
+
+class RandomClouds(Dataset):
+    def __init__(self, size, num_points, augment=None):
+        self.clouds = np.random.rand(size, num_points, 3).astype(np.float32) - 0.5
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.clouds)
+
+    def __getitem__(self, index):
+        if self.augment is None:
+            return self.clouds[index], index
+        return self.augment(self.clouds[index], index)
+
+
+class PerSampleAugment:
+    # 原流程: 每个样本单独做变换, 裁剪, 抖动, 加离群点
+    def __init__(self, bank, num_points):
+        self.bank = bank
+        self.num_points = num_points
+
+    def __call__(self, cloud, index):
+        template = torch.from_numpy(cloud)
+        self.bank.index = index
+        source, gt_quat, gt_trans, gt_T = self.bank(template)
+        source, gt_mask = farthest_subsample_points(source, self.num_points)
+        source = torch.from_numpy(jitter_pointcloud(source.numpy().copy())).float()
+        template, gt_mask = add_outliers(template, gt_mask)
+        return {'template': template, 'source': source, 'gt_mask': gt_mask,
+                'gt_quat': gt_quat, 'gt_trans': gt_trans, 'gt_T': gt_T}
+
+
+def _throughput(loader, epochs):
+    count = 0
+    next(iter(loader))
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for batch in loader:
+            count += batch['source'].shape[0]
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_size', type=int, default=2048)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--partial_points', type=int, default=768)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--pack', default=None,
+                        help='read the batched clouds from this memory-mapped container (written if missing)')
+    args = parser.parse_args()
+
+    bank = PCRNetTransform(args.dataset_size, rng=0)
+    per_sample = RandomClouds(args.dataset_size, args.num_points, PerSampleAugment(bank, args.partial_points))
+    batched = RandomClouds(args.dataset_size, args.num_points)
+    if args.pack is not None:
+        if not os.path.exists(args.pack):
+            write_pack(args.pack, batched.clouds)
+        batched = PackedClouds(args.pack, bank_size=len(bank))
+    collate = AugmentCollate(partial_registration_pipeline(bank, args.partial_points, seed=0))
+
+    print("{:>6} {:>8} {:>18} {:>18} {:>8}".format('B', 'workers', 'per-sample(pc/s)', 'batched(pc/s)', 'speedup'))
+    for B in args.batch_sizes:
+        for workers in args.num_workers:
+            old = _throughput(DataLoader(per_sample, B, shuffle=True, num_workers=workers,
+                                         collate_fn=default_collate), args.epochs)
+            new = _throughput(DataLoader(batched, B, shuffle=True, num_workers=workers,
+                                         collate_fn=collate), args.epochs)
+            print("{:>6} {:>8} {:>18.1f} {:>18.1f} {:>7.1f}x".format(B, workers, old, new, new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import time
+import argparse
+import torch
+from ops import pose
+from ops import quaternion
+
+# 位姿运算微基准: 旧的逐样本/逐点实现 vs ops/pose.py 的批量实现
+
+
+def _timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e3  # ms
+
+
+def _legacy_pred_rot(pose_pred):
+    # PANet.forward 中原来的实现: 每个样本单独旋转 eye(3) 再 torch.cat
+    pred_rot = torch.tensor([])
+    for i in range(pose_pred.shape[0]):
+        quat = pose_pred[i:i+1, :4].expand([3, -1])
+        tmp = quaternion.qrot(quat, torch.eye(3)).permute(1, 0)
+        pred_rot = torch.cat([pred_rot, tmp.unsqueeze(dim=0)], dim=0)
+    return torch.cat([pred_rot, pose_pred[:, 4:].unsqueeze(dim=2)], dim=2)
+
+
+def _legacy_transform(pose_7d, points):
+    # 原 quaternion_rotate + 平移: 每个点复制一份四元数
+    B, N, _ = points.shape
+    quat = pose_7d[:, :4].unsqueeze(1).expand([-1, N, -1]).contiguous()
+    return quaternion.qrot(quat, points) + pose_7d[:, 4:].unsqueeze(dim=1)
+
+
+def _legacy_compose(pose_new, pose_old):
+    # 原 PANet.parameter_update
+    pose_quat = quaternion.qmul(pose_new[:, :4], pose_old[:, :4])
+    pose_trans = quaternion.qrot(pose_new[:, :4], pose_old[:, 4:]) + pose_new[:, 4:]
+    return torch.cat([pose_quat, pose_trans], dim=1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32, 256])
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    print("{:>6} {:>26} {:>12} {:>12} {:>8}".format('B', 'op', 'legacy(ms)', 'batched(ms)', 'speedup'))
+    for B in args.batch_sizes:
+        pose_7d = pose.normalize_pose(torch.randn(B, 7))
+        points = torch.rand(B, args.num_points, 3)
+        rows = [
+            ('pose -> (B, 3, 4)', lambda: _legacy_pred_rot(pose_7d), lambda: pose.pose_to_transform(pose_7d)),
+            ('transform (B, N, 3)', lambda: _legacy_transform(pose_7d, points), lambda: pose.transform_points(pose_7d, points)),
+            ('compose', lambda: _legacy_compose(pose_7d, pose_7d), lambda: pose.compose(pose_7d, pose_7d)),
+        ]
+        for name, legacy, batched in rows:
+            t_old, t_new = _timeit(legacy, args.repeat), _timeit(batched, args.repeat)
+            print("{:>6} {:>26} {:>12.4f} {:>12.4f} {:>7.1f}x".format(B, name, t_old, t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import os
+import time
+import argparse
+import torch
+import torch.nn as nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from PANet import PANet, LAGNet
+
+# 导出用于 CPU 部署的 TorchScript 模型:
+#   1. 把每个 Conv + BatchNorm (running stats) 折叠成一个带偏置的 Conv, BN 换成 nn.Identity
+#      (LAGNet 的 conv2d_k/bn2d_k, conv1d_k/bn1d_k, PointAttention 各 fcn 中的 Conv1d + BatchNorm1d);
+#   2. kNN 固定用 'dense' 后端 (纯 torch 实现, 'auto' 按点数在 Python 里选后端, 无法 trace);
+#   3. 固定 num_iter, 关闭 Workspace (use_workspace=False, trace 的是不带原地缓冲区的路径), trace 后 freeze, 保存为单个文件.
+# 部署端只需要 load_exported(path), 即 torch.jit.load, 不依赖这里的 Python 模型代码.
+# optimize_for_inference 对这个模型反而更慢 (1x1 卷积换成 MKLDNN 后每层都要转换布局, B=1 N=1024: 约 650 ms vs 480 ms),
+# 所以默认不调用; 它插入的 MKLDNN 常量也无法序列化, 需要时在加载后调用.
+# main() 在导出后比较导出模型与 eager PANet.eval() 的延迟, 慢于 --max_slowdown 倍时不保留导出文件.
+#   python export.py --checkpoint best_model.t7 --output panet_ts.pt --num_iter 4
+
+
+def _fold_sequential(seq: nn.Sequential):
+    for i in range(len(seq) - 1):
+        conv, bn = seq[i], seq[i + 1]
+        if isinstance(conv, (nn.Conv1d, nn.Conv2d)) and isinstance(bn, _BatchNorm):
+            seq[i] = fuse_conv_bn_eval(conv, bn)
+            seq[i + 1] = nn.Identity().train(bn.training)
+
+
+def fold_batchnorm(model: nn.Module):
+    """
+    Fold BatchNorm layers into the preceding convs, in place. Handles adjacent Conv/BN pairs in
+    nn.Sequential and attribute pairs named conv<suffix>/bn<suffix> (conv2d_1/bn2d_1, conv1d_5/bn1d_5).
+    The model must be in eval mode; the replacement nn.Identity modules keep the BN's mode. Returns the model.
+    """
+    if model.training:
+        raise RuntimeError("fold_batchnorm needs a model in eval mode")
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            _fold_sequential(module)
+        for name, conv in list(module.named_children()):
+            bn_name = 'bn' + name[len('conv'):]
+            bn = getattr(module, bn_name, None) if name.startswith('conv') else None
+            if isinstance(conv, (nn.Conv1d, nn.Conv2d)) and isinstance(bn, _BatchNorm):
+                setattr(module, name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity().train(bn.training))
+    return model
+
+
+class PANetInference(nn.Module):
+    # 固定迭代次数, 只返回张量, 便于 trace
+    def __init__(self, model: PANet, num_iter=4):
+        super(PANetInference, self).__init__()
+        self.model = model
+        self.num_iter = num_iter
+
+    def forward(self, source, template):
+        result = self.model(source, template, num_iter=self.num_iter)
+        return result['pose_pred'], result['transform_pred']
+
+
+def export(model: PANet, path, num_iter=4, batch_size=1, num_points=1024):
+    """
+    Fold, trace, freeze and save an eval-mode PANet. Returns the frozen ScriptModule.
+    """
+    model = fold_batchnorm(model.eval())
+    model.feature_model.knn_backend = 'dense'
+    model.feature_model.use_workspace = False
+    wrapper = PANetInference(model, num_iter).eval()
+    example = (torch.rand(batch_size, num_points, 3), torch.rand(batch_size, num_points, 3))
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, example, check_trace=False)
+        traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return traced
+
+
+def load_exported(path, optimize=False):
+    """
+    Load an exported model; (pose_pred, transform_pred) = module(source, template).
+    """
+    module = torch.jit.load(path, map_location='cpu')
+    if optimize:
+        module = torch.jit.optimize_for_inference(module)
+    return module
+
+
+def _latency(fn, args, repeat):
+    with torch.no_grad():
+        fn(*args)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn(*args)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default=None, help='state_dict of PANet')
+    parser.add_argument('--output', default='panet_ts.pt')
+    parser.add_argument('--num_iter', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=1, help='example input used for tracing')
+    parser.add_argument('--num_points', type=int, default=1024, help='example input used for tracing')
+    parser.add_argument('--project_first', action='store_true', help='LAGNet gather-after-projection first layer')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--optimize', action='store_true', help='torch.jit.optimize_for_inference after loading')
+    parser.add_argument('--max_slowdown', type=float, default=1.0,
+                        help='discard the export if it is slower than eager by more than this factor')
+    args = parser.parse_args()
+
+    model = PANet(feature_model=LAGNet(project_first=args.project_first))
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model.eval()
+    reference = PANetInference(PANet(feature_model=LAGNet(project_first=args.project_first)), args.num_iter).eval()
+    reference.model.load_state_dict(model.state_dict())
+
+    exported = export(model, args.output, args.num_iter, args.batch_size, args.num_points)
+    loaded = load_exported(args.output, optimize=args.optimize)
+    # export 原地折叠了 model: 折叠后的 eager 模型在 eval / no_grad 下 (即推理路径) 也要能直接运行
+    folded = PANetInference(model, args.num_iter).eval()
+
+    # 校验: 折叠 + trace 后与原始 eager 模型 (PANet.eval(), 默认设置) 的差异, 以及延迟对比
+    # (也检查不同于 trace 输入的 batch 和点数)
+    slowdown = None
+    for B, N in [(args.batch_size, args.num_points), (args.batch_size + 1, args.num_points // 2)]:
+        source, template = torch.rand(B, N, 3), torch.rand(B, N, 3)
+        with torch.no_grad():
+            ref_pose, _ = reference(source, template)
+            out_pose, _ = loaded(source, template)
+            folded_pose, _ = folded(source, template)
+        eager_ms = _latency(reference, (source, template), args.repeat)
+        exported_ms = _latency(loaded, (source, template), args.repeat)
+        if slowdown is None:
+            slowdown = exported_ms / eager_ms     # 以 trace 时的输入形状为准
+        print("B={} N={}: max |pose diff| = {:.3e} (folded eager {:.3e}), eager {:.2f} ms, exported {:.2f} ms".format(
+            B, N, (ref_pose - out_pose).abs().max().item(), (ref_pose - folded_pose).abs().max().item(),
+            eager_ms, exported_ms))
+    if slowdown > args.max_slowdown:
+        os.remove(args.output)
+        raise SystemExit("exported model is {:.2f}x the eager latency (limit {:.2f}x), {} removed".format(
+            slowdown, args.max_slowdown, args.output))
+    print("saved to", args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import time
+import argparse
+import torch
+from PANet import PANet
+from ops import pose
+from ops.knn import knn_search
+
+# All-pairs multi-view registration.
+# 对 V 个视角两两配准, 边 (i, j) 以视角 i 为 source, 视角 j 为 template, 得到把视角 j 变到视角 i 坐标系的位姿.
+#   - 每个视角的全局特征只编码一次 (V 次 LAGNet), 第一次迭代的 template 特征直接复用这些特征;
+#   - 所有边的 FC 回归在一次调用里完成;
+#   - 之后的 refinement 迭代只重新编码被变换过的 template (按 chunk_size 分块), kNN 图按视角复用.
+# 逐对调用 PANet.forward 需要 P * (num_iter + 1) 次编码, 这里是 V + P * (num_iter - 1) 次.
+
+
+def _pair_indices(V, symmetric, device):
+    if symmetric:
+        src, tpl = torch.triu_indices(V, V, offset=1, device=device)
+    else:
+        src, tpl = torch.meshgrid(torch.arange(V, device=device), torch.arange(V, device=device), indexing='ij')
+        keep = src != tpl
+        src, tpl = src[keep], tpl[keep]
+    return src, tpl
+
+
+def _chunks(num, chunk_size):
+    chunk_size = num if chunk_size is None else chunk_size
+    for start in range(0, num, chunk_size):
+        yield slice(start, min(num, start + chunk_size))
+
+
+def inlier_fraction(source, template, threshold, chunk_size=None, backend='auto'):
+    """
+    Fraction of template points (P, N, 3) with a source point (P, M, 3) closer than threshold.
+    """
+    fraction = source.new_empty(source.shape[0])
+    for sl in _chunks(source.shape[0], chunk_size):
+        dist2 = knn_search(template[sl].transpose(1, 2), source[sl].transpose(1, 2), k=1, backend=backend)[0]
+        fraction[sl] = (dist2[:, :, 0] < threshold ** 2).float().mean(dim=1)
+    return fraction
+
+
+def register_all_pairs(model: PANet, views, num_iter=4, symmetric=True, inlier_threshold=0.05, chunk_size=8):
+    """
+    views: (V, N, 3) with V >= 2. Returns a pose graph:
+      poses (V, V, 7) and transforms (V, V, 3, 4): entry [i, j] maps view j into the frame of view i
+      (identity on the diagonal); confidence (V, V): inlier fraction of the aligned view j w.r.t. view i.
+    symmetric=True registers only i < j and fills [j, i] with the inverse pose.
+    chunk_size bounds how many pairs are re-encoded at once during refinement.
+    """
+    V = views.shape[0]
+    if V < 2:
+        raise ValueError("register_all_pairs needs at least 2 views, got {}".format(V))
+    device = views.device
+    with torch.no_grad():
+        graphs = model.feature_model.neighbor_graph(views)           # (V, N, n1), 刚体变换下不变
+        features = model.encode(views, graphs)                        # (V, 512)
+        src, tpl = _pair_indices(V, symmetric, device)
+        P = src.shape[0]
+
+        pose_pred = pose.identity_pose(P, device=device, dtype=views.dtype)
+        template_iter = views[tpl]                                    # (P, N, 3)
+        template_features = features[tpl]                             # 第一次迭代: template 还没被变换
+        for i in range(num_iter):
+            if i > 0:
+                template_features = torch.cat([model.encode(template_iter[sl], graphs[tpl[sl]])
+                                               for sl in _chunks(P, chunk_size)])
+            pose_iter = model.regress(template_features, features[src])     # (P, 7), 一次 FC
+            template_iter = pose.transform_points(pose_iter, template_iter)
+            pose_pred = model.parameter_update(pose_iter, pose_pred)
+
+        confidence_pairs = inlier_fraction(views[src], template_iter, inlier_threshold, chunk_size)
+
+    poses = pose.identity_pose(V * V, device=device, dtype=views.dtype).view(V, V, 7)
+    confidence = torch.eye(V, device=device, dtype=views.dtype)
+    poses[src, tpl] = pose_pred
+    confidence[src, tpl] = confidence_pairs
+    if symmetric:
+        poses[tpl, src] = pose.invert(pose_pred)
+        confidence[tpl, src] = confidence_pairs
+    transforms = pose.pose_to_transform(poses.view(-1, 7)).view(V, V, 3, 4)
+    return {'poses': poses, 'transforms': transforms, 'confidence': confidence,
+            'pairs': torch.stack((src, tpl), dim=1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_views', type=int, default=6)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--num_iter', type=int, default=4)
+    args = parser.parse_args()
+
+    model = PANet().eval()
+    views = torch.rand(args.num_views, args.num_points, 3) - 0.5
+    start = time.perf_counter()
+    result = register_all_pairs(model, views, args.num_iter, symmetric=False)
+    batched = time.perf_counter() - start
+
+    # 逐对调用 PANet.forward 作对比
+    start = time.perf_counter()
+    max_diff = 0.0
+    with torch.no_grad():
+        for i, j in result['pairs'].tolist():
+            pose_ij = model(views[i:i + 1], views[j:j + 1], num_iter=args.num_iter)['pose_pred'][0]
+            max_diff = max(max_diff, (pose_ij - result['poses'][i, j]).abs().max().item())
+    pairwise = time.perf_counter() - start
+    print("V={} pairs={}: all-pairs {:.2f} s, pairwise forward {:.2f} s ({:.1f}x), max |pose diff| {:.2e}".format(
+        args.num_views, result['pairs'].shape[0], batched, pairwise, pairwise / batched, max_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from . import pose
+from .transform_functions import farthest_subsample_points
+from .workspace import Workspace
+
+# Batched augmentation run inside the DataLoader collate_fn.
+# 一个 batch 是一个 dict, 点云统一为 (B, N, 3) 的 torch.Tensor; 每个增强都对整个 batch 做一次向量化运算,
+# 随机数来自当前 worker 自己的 torch.Generator (见 Compose), 不依赖全局随机状态.
+#
+# 缓冲区: 只有不会离开 collate 的临时张量 (噪声, 排列用的随机键) 会在 batch 之间复用;
+# 返回给主进程的张量每个 batch 只按最终大小分配一次 (worker 会把它们移到共享内存, 复用会覆盖主进程正在读的数据).
+
+
+class RandomPartial:
+    """
+    Keep the num_points points of `key` nearest to a random far-away anchor (see farthest_subsample_points).
+    Writes batch[key] (B, num_points, 3) and batch[mask_key] (B, N).
+    """
+    def __init__(self, num_points=768, key='template', mask_key='gt_mask'):
+        self.num_points = num_points
+        self.key = key
+        self.mask_key = mask_key
+
+    def __call__(self, batch, generator, workspace):
+        batch[self.key], batch[self.mask_key] = farthest_subsample_points(batch[self.key], self.num_points, rng=generator)
+        return batch
+
+
+class RandomTransform:
+    """
+    Apply transforms from a PCRNetTransform bank to `key` and store the result in `out_key`.
+    Bank rows are batch['index'] when present, otherwise drawn uniformly.
+    Adds igt (B, 7), gt_quat (B, 4), gt_trans (B, 3) and gt_T (B, 3, 4).
+    """
+    def __init__(self, bank, key='template', out_key='source'):
+        self.bank = bank
+        self.key = key
+        self.out_key = out_key
+
+    def __call__(self, batch, generator, workspace):
+        points = batch[self.key]
+        indices = batch.get('index')
+        if indices is None:
+            indices = torch.randint(len(self.bank), (points.shape[0],), generator=generator)
+        igt = self.bank.create_pose_7d(self.bank.transformations[indices]).to(points)     # (B, 7)
+        batch[self.out_key] = pose.transform_points(igt, points)
+        batch['igt'] = igt
+        batch['gt_quat'], batch['gt_trans'] = igt[:, :4], igt[:, 4:]
+        batch['gt_T'] = pose.pose_to_transform(igt)
+        return batch
+
+
+class Jitter:
+    """
+    Clipped Gaussian noise, same defaults as jitter_pointcloud. The input tensor is not modified.
+    """
+    def __init__(self, sigma=0.06, clip=0.05, key='source'):
+        self.sigma = sigma
+        self.clip = clip
+        self.key = key
+
+    def __call__(self, batch, generator, workspace):
+        points = batch[self.key]
+        noise = workspace.get('jitter', points.shape, points.dtype)
+        noise.normal_(0, self.sigma, generator=generator).clamp_(-self.clip, self.clip)
+        batch[self.key] = torch.add(points, noise)
+        return batch
+
+
+class AddOutliers:
+    """
+    Append num_outliers points uniform in [-1, 1]^3 to every cloud of `key` and shuffle each cloud
+    with its own permutation (as add_outliers). The mask gets zeros for the outliers.
+    """
+    def __init__(self, num_outliers=100, key='template', mask_key='gt_mask'):
+        self.num_outliers = num_outliers
+        self.key = key
+        self.mask_key = mask_key
+
+    def __call__(self, batch, generator, workspace):
+        points = batch[self.key]
+        B, N, C = points.shape
+        M = N + self.num_outliers
+        merged = workspace.get('outliers_points', (B, M, C), points.dtype)
+        merged[:, :N] = points
+        merged[:, N:].uniform_(-1, 1, generator=generator)
+        # 每个样本独立的随机排列: 对 (B, M) 的均匀随机键做 argsort
+        keys = workspace.get('outliers_keys', (B, M))
+        perm = keys.uniform_(generator=generator).argsort(dim=1)                # (B, M)
+        batch[self.key] = torch.gather(merged, 1, perm.unsqueeze(-1).expand(B, M, C))
+        if self.mask_key in batch:
+            mask = workspace.get('outliers_mask', (B, M))
+            mask[:, :N] = batch[self.mask_key]
+            mask[:, N:] = 0
+            batch[self.mask_key] = torch.gather(mask, 1, perm)
+        return batch
+
+
+class Compose:
+    """
+    Chain of batch augmentations with one RNG stream per DataLoader worker.
+    Workers seed from the worker seed chosen by the DataLoader (different for every worker and, since
+    non-persistent workers are recreated, for every epoch), mixed with `seed` when one is given;
+    the main process uses seed, or torch.initial_seed() with seed=None.
+    """
+    def __init__(self, transforms, seed=None):
+        self.transforms = list(transforms)
+        self.seed = seed
+        self._worker_id = None
+        self._generator = None
+        self._workspace = None
+
+    def _state(self):
+        info = get_worker_info()
+        worker_id = -1 if info is None else info.id
+        if self._generator is None or worker_id != self._worker_id:
+            if info is not None:
+                # info.seed = DataLoader 每个 epoch 新取的 base_seed + worker id; 只用 seed + worker id 的话
+                # 非 persistent 的 worker 每个 epoch 重建后会重放同一串增强
+                seed = info.seed if self.seed is None else int(
+                    np.random.SeedSequence([self.seed, info.seed]).generate_state(1, np.uint64)[0])
+            elif self.seed is not None:
+                seed = self.seed
+            else:
+                seed = torch.initial_seed()
+            self._generator = torch.Generator().manual_seed(seed % (1 << 63))
+            self._workspace = Workspace()
+            self._worker_id = worker_id
+        return self._generator, self._workspace
+
+    def __call__(self, batch):
+        generator, workspace = self._state()
+        with torch.no_grad():
+            for t in self.transforms:
+                batch = t(batch, generator, workspace)
+        return batch
+
+
+class AugmentCollate:
+    """
+    collate_fn: stacks the samples into (B, N, 3) once and runs the batched pipeline on the result.
+    A sample is a point cloud (N, 3) ndarray/tensor, or a (cloud, index) pair where index selects
+    the row of the transform bank, e.g. ops.cloud_io.PackedClouds.
+    """
+    def __init__(self, pipeline, key='template'):
+        self.pipeline = pipeline
+        self.key = key
+
+    def __call__(self, samples):
+        batch = {}
+        if isinstance(samples[0], (tuple, list)):
+            clouds = [s[0] for s in samples]
+            batch['index'] = torch.as_tensor([int(s[1]) for s in samples], dtype=torch.long)
+        else:
+            clouds = samples
+        if isinstance(clouds[0], np.ndarray):
+            batch[self.key] = torch.from_numpy(np.stack(clouds).astype(np.float32, copy=False))
+        else:
+            batch[self.key] = torch.stack([torch.as_tensor(c, dtype=torch.float32) for c in clouds])
+        return self.pipeline(batch)
+
+
+def partial_registration_pipeline(bank, num_points=768, num_outliers=100, sigma=0.06, clip=0.05, seed=None):
+    """
+    Batched equivalent of the per-sample chain: PCRNetTransform -> farthest_subsample_points on the
+    source (gt_mask marks the overlapping template points) -> jitter_pointcloud -> add_outliers on the template.
+    """
+    return Compose([RandomTransform(bank, key='template', out_key='source'),
+                    RandomPartial(num_points, key='source', mask_key='gt_mask'),
+                    Jitter(sigma, clip, key='source'),
+                    AddOutliers(num_outliers, key='template', mask_key='gt_mask')], seed=seed)
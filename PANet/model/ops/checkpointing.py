@@ -0,0 +1,33 @@
+import contextlib
+import torch
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+# Activation checkpointing 辅助函数.
+# 重算时 BatchNorm 会再次更新 running stats: 重算期间 momentum 置 0 并恢复 num_batches_tracked.
+
+
+@contextlib.contextmanager
+def frozen_bn_stats(bn_modules):
+    saved = [(bn, bn.momentum, bn.num_batches_tracked.clone() if bn.num_batches_tracked is not None else None)
+             for bn in bn_modules]
+    for bn in bn_modules:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, momentum, tracked in saved:
+            bn.momentum = momentum
+            if tracked is not None:
+                bn.num_batches_tracked.copy_(tracked)
+
+
+def batchnorm_modules(module):
+    return [m for m in module.modules() if isinstance(m, _BatchNorm) and m.track_running_stats]
+
+
+def checkpointed(fn, module, *args):
+    # 非 reentrant 的 checkpoint(fn, *args), 重算不改 module 中 BN 的 running stats
+    bn_modules = batchnorm_modules(module)
+    return checkpoint(fn, *args, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), frozen_bn_stats(bn_modules)))
@@ -0,0 +1,229 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+# 点云文件读取. 能映射的格式都用 np.memmap (mode='c', copy-on-write) + torch.from_numpy, 不拷贝:
+#   binary_little_endian PLY : x, y, z 为相邻 float32 属性时 (可带其它属性, 此时是跨步视图)
+#   raw float32 (.bin/.f32)  : 连续的 (N, dims) float32
+#   packed container (.pack) : 多个点云拼接存放 + 偏移表
+#   ASCII PLY / XYZ          : 一次性解析到内存
+
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+             'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+             'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+PACK_MAGIC = b'PANETPK1'
+PACK_ALIGN = 64
+
+
+def _as_tensor(array):
+    # memmap -> ndarray 视图 -> torch 张量
+    return torch.from_numpy(np.asarray(array))
+
+
+def memmap_npy(path):
+    return _as_tensor(np.load(path, mmap_mode='c'))
+
+
+def read_raw(path, dims=3, dtype=np.float32):
+    # 无文件头的 (N, dims) 数组
+    size = os.path.getsize(path)
+    itemsize = np.dtype(dtype).itemsize * dims
+    if size % itemsize != 0:
+        raise ValueError("{}: size {} is not a multiple of {} bytes".format(path, size, itemsize))
+    return _as_tensor(np.memmap(path, dtype=dtype, mode='c', shape=(size // itemsize, dims)))
+
+
+def write_raw(path, points):
+    np.ascontiguousarray(_to_numpy(points), dtype=np.float32).tofile(path)
+
+
+def _to_numpy(points):
+    if isinstance(points, torch.Tensor):
+        return points.detach().cpu().numpy()
+    return np.asarray(points)
+
+
+# ---- PLY ----
+def _read_ply_header(f):
+    if f.readline().strip() != b'ply':
+        raise ValueError("not a PLY file")
+    fmt, elements = None, []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("PLY header is not terminated by end_header")
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1][2].append((words[-1], None))
+            else:
+                elements[-1][2].append((words[-1], PLY_TYPES[words[1]]))
+        elif words[0] == 'end_header':
+            return fmt, elements, f.tell()
+
+
+def read_ply(path, fields=('x', 'y', 'z')):
+    # vertex 的 fields -> (N, len(fields)); 只有 binary_little_endian 且 fields 为相邻 float32 时是映射视图
+    with open(path, 'rb') as f:
+        fmt, elements, header_size = _read_ply_header(f)
+    offset = header_size
+    for name, count, properties in elements:
+        if name == 'vertex':
+            break
+        if fmt == 'ascii' or any(t is None for _, t in properties):
+            raise ValueError("{}: cannot locate vertex data after element '{}'".format(path, name))
+        offset += count * sum(np.dtype(t).itemsize for _, t in properties)
+    else:
+        raise ValueError("{}: no vertex element".format(path))
+    if any(t is None for _, t in properties):
+        raise ValueError("{}: list properties in the vertex element are not supported".format(path))
+    names = [p for p, _ in properties]
+    missing = [f for f in fields if f not in names]
+    if missing:
+        raise ValueError("{}: vertex has no properties {}".format(path, missing))
+    columns = [names.index(f) for f in fields]
+
+    if fmt == 'ascii':
+        with open(path, 'rb') as f:
+            f.seek(header_size)
+            data = np.loadtxt(f, dtype=np.float64, max_rows=count, ndmin=2)
+        return torch.from_numpy(np.ascontiguousarray(data[:, columns], dtype=np.float32))
+
+    byteorder = {'binary_little_endian': '<', 'binary_big_endian': '>'}[fmt]
+    dtype = np.dtype([(p, byteorder + t) for p, t in properties])
+    vertices = np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=(count,))
+    types = [properties[c][1] for c in columns]
+    adjacent = columns == list(range(columns[0], columns[0] + len(columns)))
+    if byteorder == '<' and adjacent and all(t == 'f4' for t in types) and dtype.itemsize % 4 == 0:
+        # 在原始字节上构造 (N, 3) 跨步视图, 行跨度为整个 vertex 记录
+        raw = vertices.view(np.uint8).reshape(count, dtype.itemsize)
+        start = dtype.fields[fields[0]][1]
+        view = np.ndarray((count, len(fields)), dtype='<f4', buffer=raw, offset=start,
+                          strides=(dtype.itemsize, 4))
+        return torch.from_numpy(view)
+    return torch.from_numpy(np.stack([vertices[f].astype(np.float32) for f in fields], axis=1))
+
+
+def write_ply(path, points, binary=True):
+    points = np.ascontiguousarray(_to_numpy(points), dtype=np.float32)
+    header = "ply\nformat {} 1.0\nelement vertex {}\nproperty float x\nproperty float y\nproperty float z\nend_header\n"
+    with open(path, 'wb') as f:
+        f.write(header.format('binary_little_endian' if binary else 'ascii', points.shape[0]).encode('ascii'))
+        if binary:
+            points.astype('<f4').tofile(f)
+        else:
+            np.savetxt(f, points, fmt='%.8g')
+
+
+def read_xyz(path):
+    # 每行一个点, 多余的列忽略
+    return torch.from_numpy(np.loadtxt(path, dtype=np.float32, usecols=(0, 1, 2), ndmin=2))
+
+
+def load_cloud(path):
+    # 按扩展名选择读取方式
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.ply':
+        return read_ply(path)
+    if ext in ('.bin', '.f32', '.raw'):
+        return read_raw(path)
+    if ext in ('.xyz', '.txt', '.pts'):
+        return read_xyz(path)
+    if ext == '.npy':
+        return memmap_npy(path)
+    raise ValueError("unsupported point cloud format: {}".format(path))
+
+
+def iter_chunks(points, chunk_size=1 << 20):
+    # (N, C) -> 依次返回 (<= chunk_size, C) 的视图, 用于一次读不完的映射文件
+    for start in range(0, points.shape[0], chunk_size):
+        yield points[start:start + chunk_size]
+
+
+# ---- packed container ----
+# 文件布局: magic (8 字节) | header 长度 (uint64) | JSON header | 对齐到 64 字节 | float32 点 (total, dims)
+# header: {"dims": 3, "offsets": [0, n0, n0 + n1, ...]}; 第 i 个点云为 points[offsets[i]:offsets[i + 1]]
+def write_pack(path, clouds, dims=3):
+    clouds = list(clouds)
+    offsets = np.zeros(len(clouds) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([c.shape[0] for c in clouds])
+    header = json.dumps({'dims': dims, 'offsets': offsets.tolist()}).encode('ascii')
+    data_offset = -(-(len(PACK_MAGIC) + 8 + len(header)) // PACK_ALIGN) * PACK_ALIGN
+    with open(path, 'wb') as f:
+        f.write(PACK_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        f.write(b'\0' * (data_offset - f.tell()))
+        for cloud in clouds:
+            cloud = np.ascontiguousarray(_to_numpy(cloud), dtype='<f4')
+            if cloud.ndim != 2 or cloud.shape[1] != dims:
+                raise ValueError("expected (N, {}) clouds, got {}".format(dims, cloud.shape))
+            cloud.tofile(f)
+
+
+class CloudPack:
+    # pack[i]: 第 i 个点云的 (N_i, dims) 视图; pack.points: 全部点 (total, dims)
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise ValueError("{} is not a point cloud pack".format(path))
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size).decode('ascii'))
+        data_offset = -(-(len(PACK_MAGIC) + 8 + header_size) // PACK_ALIGN) * PACK_ALIGN
+        self.path = path
+        self.dims = header['dims']
+        self.offsets = np.asarray(header['offsets'], dtype=np.int64)
+        total = int(self.offsets[-1])
+        if total == 0:
+            self.points = torch.empty(0, self.dims)
+        else:
+            self.points = _as_tensor(np.memmap(path, dtype='<f4', mode='c', offset=data_offset,
+                                               shape=(total, self.dims)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.points[self.offsets[index]:self.offsets[index + 1]]
+
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def uniform(self):
+        # 所有点云点数相同时返回 (C, N, dims) 视图, 否则 None
+        sizes = self.sizes()
+        if len(sizes) == 0 or (sizes != sizes[0]).any():
+            return None
+        return self.points.view(len(sizes), int(sizes[0]), self.dims)
+
+
+class PackedClouds(Dataset):
+    # 样本为 (点云视图, index), 即 AugmentCollate 的输入格式; index 选择变换 bank 的行 (给定 bank_size 时取模)
+    def __init__(self, path, bank_size=None):
+        self.path = path
+        self.bank_size = bank_size
+        self.pack = CloudPack(path)
+
+    def __len__(self):
+        return len(self.pack)
+
+    def __getitem__(self, index):
+        row = index if self.bank_size is None else index % self.bank_size
+        return self.pack[index], row
+
+    def __getstate__(self):
+        # 传给 DataLoader worker 时只传路径, 每个 worker 自己重新映射文件
+        return {'path': self.path, 'bank_size': self.bank_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['bank_size'])
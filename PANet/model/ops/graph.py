@@ -0,0 +1,51 @@
+import torch
+import torch.nn.functional as F
+from torch.nn.modules.batchnorm import _BatchNorm
+
+# EdgeConv 类模块共用的邻域算子.
+# 对邻居坐标做无偏置的 1x1 卷积 (线性投影) 时, 先对每个点投影一次再按 kNN 下标 gather,
+# 与先 gather 出 (B, C, N, k) 再卷积在数学上等价, 但投影量少 k 倍, 也不需要构造坐标邻域张量.
+
+
+def gather_neighbors(feature, idx, out=None):
+    """
+    feature: (B, C, N), idx: (B, M, k) indices into N -> (B, C, M, k), contiguous.
+    out: optional output buffer.
+    """
+    B, C, N = feature.shape
+    _, M, k = idx.shape
+    index = idx.reshape(B, 1, M * k).expand(B, C, M * k)
+    if out is None:
+        return torch.gather(feature, 2, index).view(B, C, M, k)
+    torch.gather(feature, 2, index, out=out.view(B, C, M * k))
+    return out
+
+
+def project_points(feature, conv):
+    """
+    Apply a 1x1 Conv1d/Conv2d's weight and bias to per-point features (B, C_in, N) -> (B, C_out, N).
+    """
+    weight = conv.weight.view(conv.weight.shape[0], conv.weight.shape[1], 1)
+    return F.conv1d(feature, weight, conv.bias)
+
+
+def project_gather(feature, conv, idx):
+    """
+    Equivalent to conv(gather_neighbors(feature, idx)) for a 1x1 conv, but the
+    projection runs once per point instead of once per (point, neighbour) pair.
+    """
+    return gather_neighbors(project_points(feature, conv), idx)
+
+
+def project_gather_activated(feature, conv, bn, idx):
+    """
+    Eval-mode variant of relu(bn(project_gather(feature, conv, idx))): with running statistics
+    BatchNorm and ReLU are pointwise too, so they are applied once per point before the gather.
+    bn: BatchNorm1d or BatchNorm2d (only its running statistics and affine parameters are used),
+    or anything else (e.g. nn.Identity after BN folding) to skip the normalisation.
+    """
+    activated = project_points(feature, conv)
+    if isinstance(bn, _BatchNorm):
+        activated = F.batch_norm(activated, bn.running_mean, bn.running_var, bn.weight, bn.bias,
+                                 False, 0.0, bn.eps)
+    return gather_neighbors(F.relu(activated, inplace=True), idx)
@@ -0,0 +1,111 @@
+import time
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+from . import pose
+from .knn import knn_search, select_backend
+
+# Batched point-to-point ICP, 全部在张量上完成, 用于在 PANet 的位姿之后做精修.
+# 与 PANet 相同的约定: template 被移动到 source, 位姿为 (B, 7) [qw, qx, qy, qz, tx, ty, tz].
+# 每次迭代: 对变换后的 template 的每个点找最近的 source 点 -> 加权 Kabsch (SVD 闭式解) -> 复合到当前位姿.
+
+
+class NearestSource:
+    """
+    Nearest source point of every query point, (B, M, 3) -> squared distances (B, M), indices (B, M).
+    The source does not move during ICP, so the kdtree backend builds its trees once and reuses them.
+    """
+    def __init__(self, source, backend='auto'):
+        self.source = source
+        self.source_t = source.transpose(1, 2).contiguous()     # (B, 3, N)
+        if backend == 'auto':
+            # CPU 上树只建一次, 每次迭代的查询远快于重新计算 (B, M, N) 距离矩阵
+            backend = 'kdtree' if source.device.type == 'cpu' else select_backend(self.source_t, self.source_t, 1)
+        self.backend = backend
+        self.trees = None
+        if backend == 'kdtree':
+            points = source.detach().cpu().numpy()
+            self.trees = [cKDTree(p) for p in points]
+
+    def __call__(self, query):
+        if self.trees is None:
+            dist2, idx = knn_search(query.transpose(1, 2).contiguous(), self.source_t, k=1, backend=self.backend)
+            return dist2[:, :, 0], idx[:, :, 0]
+        q_np = query.detach().cpu().numpy()
+        results = [tree.query(q, k=1, workers=-1) for tree, q in zip(self.trees, q_np)]
+        dist = torch.from_numpy(np.stack([d for d, _ in results]))
+        idx = torch.from_numpy(np.stack([i for _, i in results]).astype(np.int64))
+        return (dist ** 2).to(device=query.device, dtype=query.dtype), idx.to(query.device)
+
+
+def kabsch(points, targets, weights=None):
+    """
+    Rigid pose (B, 7) minimising sum_i w_i |R p_i + t - q_i|^2 for points, targets (B, N, 3)
+    and optional weights (B, N). Samples with fewer than 3 effective correspondences get the identity.
+    """
+    if weights is None:
+        weights = points.new_ones(points.shape[:2])
+    w_sum = weights.sum(dim=1, keepdim=True)                               # (B, 1)
+    w = (weights / w_sum.clamp(min=1e-12)).unsqueeze(-1)                    # (B, N, 1)
+    p_mean = (w * points).sum(dim=1, keepdim=True)                         # (B, 1, 3)
+    q_mean = (w * targets).sum(dim=1, keepdim=True)
+    H = torch.bmm((points - p_mean).transpose(1, 2), w * (targets - q_mean))    # (B, 3, 3)
+    U, _, Vh = torch.linalg.svd(H)
+    V = Vh.transpose(1, 2)
+    # 反射修正: det(V U^T) = -1 时翻转最小奇异值对应的方向
+    d = torch.det(torch.bmm(V, U.transpose(1, 2)))
+    D = torch.diag_embed(torch.stack((torch.ones_like(d), torch.ones_like(d), d), dim=1))
+    R = torch.bmm(torch.bmm(V, D), U.transpose(1, 2))
+    t = q_mean.squeeze(1) - torch.bmm(R, p_mean.transpose(1, 2)).squeeze(-1)
+    result = torch.cat((pose.mat_to_quat(R), t), dim=1)
+    valid = (w_sum >= 3).to(result)     # 权重为 0/1 时即为至少 3 对有效对应点
+    return valid * result + (1 - valid) * pose.identity_pose(result.shape[0], result.device, result.dtype)
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def icp(source, template, init_pose=None, num_iter=10, max_dist=None, tol=1e-6, backend='auto'):
+    """
+    Refine the pose moving template (B, N, 3) onto source (B, M, 3), starting from init_pose (B, 7).
+    max_dist: correspondences farther than this are ignored (partial overlap, outliers).
+    tol: stop once every sample's update rotates and translates less than tol.
+    Returns pose_pred, transformed_template, rmse of the last correspondences, the number of
+    iterations run and the time spent on correspondence search and on the closed-form updates.
+    """
+    B = template.shape[0]
+    if init_pose is None:
+        pose_pred = pose.identity_pose(B, device=template.device, dtype=template.dtype)
+    else:
+        pose_pred = init_pose.to(template)
+    moved = pose.transform_points(pose_pred, template)
+    timing = {'correspondence_ms': 0.0, 'solve_ms': 0.0}
+
+    start = time.perf_counter()
+    nearest = NearestSource(source, backend)
+    dist2 = None
+    iterations = 0
+    for iterations in range(1, num_iter + 1):
+        dist2, idx = nearest(moved)                                                     # (B, N)
+        matched = torch.gather(source, 1, idx.unsqueeze(-1).expand(-1, -1, source.shape[2]))
+        weights = None if max_dist is None else (dist2 <= max_dist ** 2).to(moved.dtype)
+        _sync(moved.device)
+        mid = time.perf_counter()
+        timing['correspondence_ms'] += (mid - start) * 1e3
+
+        delta = kabsch(moved, matched, weights)
+        moved = pose.transform_points(delta, moved)
+        pose_pred = pose.compose(delta, pose_pred)
+        converged = tol is not None and bool(((pose.rotation_angle(delta) < tol) &
+                                              (delta[:, 4:].norm(dim=1) < tol)).all())
+        _sync(moved.device)
+        start = time.perf_counter()
+        timing['solve_ms'] += (start - mid) * 1e3
+        if converged:
+            break
+
+    rmse = None if dist2 is None else dist2.mean(dim=1).sqrt()
+    return {'pose_pred': pose_pred, 'transformed_template': moved, 'rmse': rmse,
+            'num_iter': iterations, 'timing': timing}
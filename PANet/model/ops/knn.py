@@ -0,0 +1,123 @@
+import torch
+import numpy as np
+from scipy.spatial import cKDTree
+
+# kNN engine. 所有后端共用同一个接口:
+#   query: (B, C, M), ref: (B, C, N)  ->  dist2: (B, M, k) 升序平方距离, idx: (B, M, k)
+# 'dense'     : 原始实现, 一次构建 (B, M, N) 距离矩阵
+# 'blockwise' : 精确, 按 query/ref 分块流式计算并维护 running top-k, 显存/内存 O(B * block_q * block_r)
+# 'kdtree'    : CPU 上用 scipy cKDTree, 适合 5w~20w 点的大场景
+# ref_mask (B, N) bool: 变长点云补齐成一个 batch 时标记有效的参考点, 补齐的点不会被选为邻居 (见 ops/packing.py)
+
+BACKENDS = ('dense', 'blockwise', 'kdtree')
+
+# dense 距离矩阵允许的最大字节数, 超过后 'auto' 改用其它后端
+DENSE_MAX_BYTES = 256 * 1024 * 1024
+# kdtree 只在点数足够大时才比 blockwise 快
+KDTREE_MIN_POINTS = 8192
+
+
+def select_backend(query, ref, k):
+    """
+    Heuristic used by backend='auto'.
+    Dense while the (B, M, N) matrix fits in DENSE_MAX_BYTES, a KD-tree for large CPU
+    clouds, otherwise the blockwise exact search.
+    """
+    B, _, M = query.shape
+    N = ref.shape[2]
+    if B * M * N * query.element_size() <= DENSE_MAX_BYTES:
+        return 'dense'
+    if query.device.type == 'cpu' and N >= KDTREE_MIN_POINTS:
+        return 'kdtree'
+    return 'blockwise'
+
+
+def _neg_pairwise_distance(query, ref):
+    # 与原 knn 相同的计算顺序, 保证 dense 后端结果逐位一致
+    inner = -2 * torch.matmul(query.transpose(2, 1).contiguous(), ref)     # (B, M, N)
+    qq = torch.sum(query ** 2, dim=1, keepdim=True).transpose(2, 1)         # (B, M, 1)
+    rr = torch.sum(ref ** 2, dim=1, keepdim=True)                           # (B, 1, N)
+    return -rr - inner - qq
+
+
+def _mask_ref(neg_dist, ref_mask):
+    if ref_mask is None:
+        return neg_dist
+    return neg_dist.masked_fill(~ref_mask.unsqueeze(1), float('-inf'))
+
+
+def knn_dense(query, ref, k, ref_mask=None):
+    neg_dist, idx = _mask_ref(_neg_pairwise_distance(query, ref), ref_mask).topk(k=k, dim=-1)
+    return -neg_dist, idx
+
+
+def knn_blockwise(query, ref, k, block_q=None, block_r=None, max_bytes=DENSE_MAX_BYTES // 4, ref_mask=None):
+    """
+    Exact kNN without the full (B, M, N) matrix: query blocks are streamed against
+    reference blocks and a running top-k is merged after every reference block.
+    """
+    B, _, M = query.shape
+    N = ref.shape[2]
+    elem = query.element_size()
+    if block_r is None:
+        block_r = min(N, max(k, 4096))
+    if block_q is None:
+        block_q = max(1, min(M, max_bytes // max(1, B * block_r * elem)))
+
+    dist_out = query.new_empty((B, M, k))
+    idx_out = torch.empty((B, M, k), dtype=torch.long, device=query.device)
+    for qs in range(0, M, block_q):
+        q = query[:, :, qs:qs + block_q]
+        best_neg, best_idx = None, None
+        for rs in range(0, N, block_r):
+            neg = _neg_pairwise_distance(q, ref[:, :, rs:rs + block_r])
+            neg = _mask_ref(neg, None if ref_mask is None else ref_mask[:, rs:rs + block_r])
+            neg, idx = neg.topk(k=min(k, neg.shape[-1]), dim=-1)
+            idx = idx + rs
+            if best_neg is not None:
+                neg = torch.cat((best_neg, neg), dim=-1)
+                idx = torch.cat((best_idx, idx), dim=-1)
+                neg, sel = neg.topk(k=min(k, neg.shape[-1]), dim=-1)
+                idx = torch.gather(idx, -1, sel)
+            best_neg, best_idx = neg, idx
+        dist_out[:, qs:qs + block_q] = -best_neg
+        idx_out[:, qs:qs + block_q] = best_idx
+    return dist_out, idx_out
+
+
+def knn_kdtree(query, ref, k, workers=-1, ref_mask=None):
+    """
+    CPU KD-tree search (scipy cKDTree), one tree per cloud in the batch, built on the valid points only.
+    Returned tensors live on the query's device.
+    """
+    B, _, M = query.shape
+    q_np = query.detach().transpose(2, 1).cpu().numpy()
+    r_np = ref.detach().transpose(2, 1).cpu().numpy()
+    dist = np.empty((B, M, k), dtype=np.float64)
+    idx = np.empty((B, M, k), dtype=np.int64)
+    valid = None if ref_mask is None else ref_mask.cpu().numpy()
+    for b in range(B):
+        points = r_np[b] if valid is None else r_np[b][valid[b]]
+        d, i = cKDTree(points).query(q_np[b], k=k, workers=workers)
+        dist[b] = d.reshape(M, k)
+        idx[b] = i.reshape(M, k) if valid is None else np.flatnonzero(valid[b])[i.reshape(M, k)]
+    dist = torch.from_numpy(dist ** 2).to(device=query.device, dtype=query.dtype)
+    return dist, torch.from_numpy(idx).to(query.device)
+
+
+def knn_search(query, ref, k, backend='auto', ref_mask=None):
+    """
+    k nearest neighbours of every query point among the reference points.
+    query: (B, C, M), ref: (B, C, N). Returns squared distances and indices, both (B, M, k),
+    sorted from nearest to farthest. ref_mask (B, N): only these reference points are candidates;
+    every cloud needs at least k of them.
+    """
+    if backend == 'auto':
+        backend = select_backend(query, ref, k)
+    if backend == 'dense':
+        return knn_dense(query, ref, k, ref_mask=ref_mask)
+    elif backend == 'blockwise':
+        return knn_blockwise(query, ref, k, ref_mask=ref_mask)
+    elif backend == 'kdtree':
+        return knn_kdtree(query, ref, k, ref_mask=ref_mask)
+    raise ValueError("unknown knn backend: {}".format(backend))
@@ -0,0 +1,141 @@
+import math
+import torch
+from . import pose
+
+# Batched registration metrics, 在输入所在的 device 上计算.
+# 变换可以是 (B, 3, 4) / (B, 4, 4) 矩阵, 也可以是 (B, 7) 的 pose_7d.
+
+
+def _as_transform(T: torch.Tensor):
+    if T.shape[-1] == 7:
+        return pose.pose_to_transform(T)
+    return T[:, :3, :]
+
+
+def mat2euler(R: torch.Tensor, seq='zyx'):
+    """
+    (B, 3, 3) -> (B, 3) Euler angles in radians [x, y, z], same as scipy's as_euler(seq)[:, [2, 1, 0]].
+    """
+    if seq == 'zyx':
+        # R = Rx(x) Ry(y) Rz(z): R02 = sin(y)
+        s, c1, c2, s1, s2 = R[:, 0, 2], R[:, 2, 2], R[:, 0, 0], -R[:, 1, 2], -R[:, 0, 1]
+        lock_a, lock_b = R[:, 1, 0], R[:, 1, 1]
+    elif seq == 'xyz':
+        # R = Rz(z) Ry(y) Rx(x): R20 = -sin(y)
+        s, c1, c2, s1, s2 = -R[:, 2, 0], R[:, 0, 0], R[:, 2, 2], R[:, 1, 0], R[:, 2, 1]
+        lock_a, lock_b = -R[:, 1, 2], R[:, 1, 1]
+    else:
+        raise ValueError("unsupported euler sequence: {}".format(seq))
+    cos_mid = torch.sqrt(c2 * c2 + s2 * s2)
+    mid = torch.atan2(s, cos_mid)
+    first = torch.atan2(s1, c1)       # x for 'zyx', z for 'xyz'
+    last = torch.atan2(s2, c2)        # z for 'zyx', x for 'xyz'
+    # 万向节锁: 只有 first + last (或差) 可确定, 与 scipy 一样令 seq 的第三个角 (first) 为 0
+    locked = cos_mid < 1e-6
+    first = torch.where(locked, torch.zeros_like(first), first)
+    last = torch.where(locked, torch.atan2(lock_a, lock_b), last)
+    return torch.stack((first, mid, last), dim=1)
+
+
+def rotation_error(R_pred: torch.Tensor, R_gt: torch.Tensor):
+    """
+    Isotropic rotation error in degrees, angle of R_gt^T R_pred. (B, 3, 3) -> (B,)
+    """
+    R = torch.bmm(R_gt.transpose(1, 2), R_pred)
+    # atan2(2 sin, 2 cos) 在 0° 和 180° 附近都比 acos((trace - 1) / 2) 精确
+    sin2 = torch.stack((R[:, 2, 1] - R[:, 1, 2], R[:, 0, 2] - R[:, 2, 0], R[:, 1, 0] - R[:, 0, 1]), dim=1).norm(dim=1)
+    cos2 = R[:, 0, 0] + R[:, 1, 1] + R[:, 2, 2] - 1
+    return torch.rad2deg(torch.atan2(sin2, cos2))
+
+
+def translation_error(t_pred: torch.Tensor, t_gt: torch.Tensor):
+    """
+    Euclidean translation error. (B, 3) -> (B,)
+    """
+    return (t_pred - t_gt).norm(dim=-1)
+
+
+def euler_error(R_pred: torch.Tensor, R_gt: torch.Tensor, seq='zyx'):
+    """
+    Per-axis absolute Euler angle difference in degrees, wrapped to [0, 180]. (B, 3, 3) -> (B, 3)
+    """
+    diff = torch.rad2deg(mat2euler(R_pred, seq) - mat2euler(R_gt, seq))
+    return (torch.remainder(diff + 180, 360) - 180).abs()
+
+
+def rmse(points: torch.Tensor, T_pred: torch.Tensor, T_gt: torch.Tensor):
+    """
+    RMSE between points (B, N, 3) transformed by T_pred and by T_gt. -> (B,)
+    """
+    T_pred, T_gt = _as_transform(T_pred), _as_transform(T_gt)
+    diff = T_pred - T_gt                                                     # (B, 3, 4)
+    residual = torch.baddbmm(diff[:, :, 3].unsqueeze(1), points, diff[:, :, :3].transpose(1, 2))
+    return residual.pow(2).sum(dim=-1).mean(dim=-1).sqrt()
+
+
+def registration_errors(T_pred: torch.Tensor, T_gt: torch.Tensor, points: torch.Tensor = None, seq='zyx'):
+    """
+    All per-sample errors of a batch as a dict of tensors.
+    """
+    T_pred, T_gt = _as_transform(T_pred), _as_transform(T_gt)
+    R_pred, R_gt = T_pred[:, :, :3], T_gt[:, :, :3]
+    errors = {
+        'rot_iso': rotation_error(R_pred, R_gt),
+        'trans_iso': translation_error(T_pred[:, :, 3], T_gt[:, :, 3]),
+        'rot_euler': euler_error(R_pred, R_gt, seq),
+        'trans_abs': (T_pred[:, :, 3] - T_gt[:, :, 3]).abs(),
+    }
+    if points is not None:
+        errors['rmse'] = rmse(points, T_pred, T_gt)
+    return errors
+
+
+class RegistrationMeter:
+    # 测试集上的累积统计: 和 / 平方和 / 最大值以 float64 留在 device 上, 只有 compute() 同步一次
+    # rot_threshold (度) / trans_threshold: 成功率的阈值
+    def __init__(self, seq='zyx', rot_threshold=1.0, trans_threshold=0.01):
+        self.seq = seq
+        self.rot_threshold = rot_threshold
+        self.trans_threshold = trans_threshold
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self._sum = {}
+        self._sq = {}
+        self._max = {}
+        self._success = None
+
+    def update(self, T_pred, T_gt, points=None):
+        with torch.no_grad():
+            errors = registration_errors(T_pred, T_gt, points, self.seq)
+            for name, value in errors.items():
+                value = value.double()
+                if value.dim() == 1:
+                    value = value.unsqueeze(1)
+                s, q, m = value.sum(dim=0), value.pow(2).sum(dim=0), value.max(dim=0)[0]
+                if name in self._sum:
+                    self._sum[name] += s
+                    self._sq[name] += q
+                    self._max[name] = torch.maximum(self._max[name], m)
+                else:
+                    self._sum[name], self._sq[name], self._max[name] = s, q, m
+            success = ((errors['rot_iso'] < self.rot_threshold) & (errors['trans_iso'] < self.trans_threshold)).sum()
+            self._success = success if self._success is None else self._success + success
+            self.count += errors['rot_iso'].shape[0]
+        return errors
+
+    def compute(self):
+        # {name}_mae / _rmse / _max (euler / abs 指标对三个轴取平均) 以及 success_rate
+        if self.count == 0:
+            return {}
+        names = list(self._sum)
+        stacked = torch.stack([torch.stack((self._sum[n].mean(), self._sq[n].mean(), self._max[n].max()))
+                               for n in names]).cpu()
+        result = {}
+        for name, (s, q, m) in zip(names, stacked.tolist()):
+            result[name + '_mae'] = s / self.count
+            result[name + '_rmse'] = math.sqrt(q / self.count)
+            result[name + '_max'] = m
+        result['success_rate'] = self._success.item() / self.count
+        return result
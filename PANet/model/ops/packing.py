@@ -0,0 +1,65 @@
+import torch
+
+# 变长点云 batch.
+# 每个点云补齐到 batch 内最大点数, 得到 (B, N_max, 3) 的 points 和 (B, N_max) 的 bool mask (True 为有效点).
+# 补齐位置填的是该点云第一个点的副本, 坐标有界, 不会产生 NaN/Inf; 真正屏蔽靠 mask:
+#   kNN      : 补齐的点不作为候选邻居 (ops/knn.py 的 ref_mask)
+#   1x1 conv / BN(eval) / PointAttention : 逐点运算, 补齐的点不影响有效点
+#   max pool : masked_max 只在有效点上取最大值
+#   位姿变换 : 逐点运算
+# 训练模式下 BN 的 batch 统计量仍会包含补齐的点, 严格等价只在 eval 模式下成立.
+
+
+def pad_clouds(clouds, multiple=1):
+    """
+    List of (N_i, C) clouds -> points (B, N_max, C) and mask (B, N_max).
+    N_max is rounded up to a multiple of `multiple`.
+    """
+    lengths = torch.as_tensor([c.shape[0] for c in clouds], dtype=torch.long)
+    if (lengths == 0).any():
+        raise ValueError("empty point cloud in batch")
+    N = -(-int(lengths.max()) // multiple) * multiple
+    first = clouds[0]
+    points = torch.empty(len(clouds), N, first.shape[1], dtype=first.dtype, device=first.device)
+    for b, cloud in enumerate(clouds):
+        points[b, :cloud.shape[0]] = cloud
+        points[b, cloud.shape[0]:] = cloud[:1]
+    return points, lengths_to_mask(lengths.to(first.device), N)
+
+
+def pack_to_padded(points, offsets, multiple=1):
+    """
+    Packed (total, C) points with offsets (B + 1,), e.g. ops.cloud_io.CloudPack, -> points, mask.
+    """
+    offsets = [int(o) for o in offsets]
+    return pad_clouds([points[s:e] for s, e in zip(offsets[:-1], offsets[1:])], multiple)
+
+
+def lengths_to_mask(lengths, N):
+    return torch.arange(N, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)     # (B, N)
+
+
+def unpad(points, mask):
+    """
+    (B, N_max, C) points -> list of the (N_i, C) valid points of each cloud (valid points first, as from pad_clouds).
+    """
+    lengths = mask.sum(dim=1).tolist()
+    return [points[b, :n] for b, n in enumerate(lengths)]
+
+
+def masked_max(features, mask, dim=2):
+    """
+    Max over the valid points only. features (B, C, N) with mask (B, N).
+    """
+    if mask is None:
+        return torch.max(features, dim=dim)[0]
+    return torch.max(features.masked_fill(~mask.unsqueeze(1), float('-inf')), dim=dim)[0]
+
+
+def length_buckets(lengths, max_batch):
+    """
+    Indices of the clouds grouped into batches of <= max_batch clouds of similar size (sorted by length),
+    which keeps the padding per batch small.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: int(lengths[i]))
+    return [order[i:i + max_batch] for i in range(0, len(order), max_batch)]
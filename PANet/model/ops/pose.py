@@ -0,0 +1,156 @@
+import torch
+import torch.nn.functional as F
+
+# Batched SE(3) pose algebra.
+# pose_7d: (B, 7) = [qw, qx, qy, qz, tx, ty, tz], 四元数为 (w, x, y, z) 顺序, 作用方式为 p' = R * p + t.
+# 所有函数都在整个 batch 上向量化, 没有逐样本的 Python 循环.
+
+
+def identity_pose(batch_size: int, device=None, dtype=torch.float32):
+    pose = torch.zeros(batch_size, 7, device=device, dtype=dtype)
+    pose[:, 0] = 1
+    return pose
+
+
+def normalize_pose(vector: torch.Tensor):
+    """
+    Normalize the quaternion part of a (B, 7) vector; the translation is left as is.
+    """
+    quat = F.normalize(vector[:, 0:4], dim=1)
+    return torch.cat([quat, vector[:, 4:]], dim=1).view([-1, 7])
+
+
+def qmul(q: torch.Tensor, r: torch.Tensor):
+    """
+    Hamilton product q * r of quaternions of shape (*, 4) (apply r first, then q).
+    """
+    w1, x1, y1, z1 = q.unbind(-1)
+    w2, x2, y2, z2 = r.unbind(-1)
+    return torch.stack((w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2), dim=-1)
+
+
+def qconj(q: torch.Tensor):
+    return torch.cat([q[..., :1], -q[..., 1:]], dim=-1)
+
+
+def qrot(q: torch.Tensor, v: torch.Tensor):
+    """
+    Rotate vectors v (*, 3) by quaternions q (*, 4); leading dims broadcast.
+    Cheaper than building a matrix when there is only one vector per quaternion.
+    """
+    qvec = q[..., 1:]
+    qvec, v = torch.broadcast_tensors(qvec, v)
+    uv = torch.cross(qvec, v, dim=-1)
+    uuv = torch.cross(qvec, uv, dim=-1)
+    return v + 2 * (q[..., :1] * uv + uuv)
+
+
+def quat_to_mat(q: torch.Tensor):
+    """
+    (*, 4) quaternions -> (*, 3, 3) rotation matrices.
+    """
+    q0, q1, q2, q3 = q.unbind(-1)
+    R11 = q0 * q0 + q1 * q1 - q2 * q2 - q3 * q3
+    R12 = 2 * (q1 * q2 - q0 * q3)
+    R13 = 2 * (q1 * q3 + q0 * q2)
+    R21 = 2 * (q1 * q2 + q0 * q3)
+    R22 = q0 * q0 + q2 * q2 - q1 * q1 - q3 * q3
+    R23 = 2 * (q2 * q3 - q0 * q1)
+    R31 = 2 * (q1 * q3 - q0 * q2)
+    R32 = 2 * (q2 * q3 + q0 * q1)
+    R33 = q0 * q0 + q3 * q3 - q1 * q1 - q2 * q2
+    return torch.stack((R11, R12, R13, R21, R22, R23, R31, R32, R33), dim=-1).view(q.shape[:-1] + (3, 3))
+
+
+def mat_to_quat(R: torch.Tensor):
+    """
+    (*, 3, 3) rotation matrices -> (*, 4) unit quaternions with w >= 0.
+    Every sample takes the numerically best of the four branches of Shepperd's method.
+    """
+    R00, R01, R02 = R[..., 0, 0], R[..., 0, 1], R[..., 0, 2]
+    R10, R11, R12 = R[..., 1, 0], R[..., 1, 1], R[..., 1, 2]
+    R20, R21, R22 = R[..., 2, 0], R[..., 2, 1], R[..., 2, 2]
+    t = torch.stack((1 + R00 + R11 + R22,
+                     1 + R00 - R11 - R22,
+                     1 - R00 + R11 - R22,
+                     1 - R00 - R11 + R22), dim=-1)                             # (*, 4): 4w², 4x², 4y², 4z²
+    candidates = torch.stack((
+        torch.stack((t[..., 0], R21 - R12, R02 - R20, R10 - R01), dim=-1),
+        torch.stack((R21 - R12, t[..., 1], R10 + R01, R02 + R20), dim=-1),
+        torch.stack((R02 - R20, R10 + R01, t[..., 2], R21 + R12), dim=-1),
+        torch.stack((R10 - R01, R02 + R20, R21 + R12, t[..., 3]), dim=-1)), dim=-2)  # (*, 4, 4)
+    best = t.argmax(dim=-1)[..., None, None].expand(t.shape[:-1] + (1, 4))
+    quat = F.normalize(torch.gather(candidates, -2, best).squeeze(-2), dim=-1)
+    return torch.where(quat[..., :1] < 0, -quat, quat)
+
+
+def compose(pose_new: torch.Tensor, pose_old: torch.Tensor):
+    """
+    Pose of applying pose_old first and pose_new second: R = R_new R_old, t = R_new t_old + t_new.
+    """
+    quat = qmul(pose_new[:, :4], pose_old[:, :4])
+    trans = qrot(pose_new[:, :4], pose_old[:, 4:]) + pose_new[:, 4:]
+    return torch.cat([quat, trans], dim=1)
+
+
+def invert(pose: torch.Tensor):
+    quat = qconj(pose[:, :4])
+    trans = -qrot(quat, pose[:, 4:])
+    return torch.cat([quat, trans], dim=1)
+
+
+def rotation_angle(pose: torch.Tensor):
+    """
+    Rotation angle (radians, in [0, pi]) of each pose in a (B, 7) batch.
+    """
+    quat = pose[:, :4]
+    return 2 * torch.atan2(quat[:, 1:].norm(dim=1), quat[:, 0].abs())
+
+
+def rotate_points(pose: torch.Tensor, points: torch.Tensor):
+    """
+    points: (B, N, 3) with pose (B, 7), or (N, 3) with pose (1, 7). Returns R * p.
+    """
+    R = quat_to_mat(pose[:, :4])
+    if points.dim() == 2:
+        return torch.mm(points, R[0].transpose(0, 1))
+    return torch.bmm(points, R.transpose(1, 2))
+
+
+def transform_points(pose: torch.Tensor, points: torch.Tensor):
+    """
+    Fused rotate + translate, R * p + t, as one (b)addmm per batch.
+    points: (B, N, 3) with pose (B, 7), or (N, 3) with pose (1, 7).
+    """
+    R = quat_to_mat(pose[:, :4])
+    if points.dim() == 2:
+        return torch.addmm(pose[:, 4:], points, R[0].transpose(0, 1))
+    return torch.baddbmm(pose[:, 4:].unsqueeze(1), points, R.transpose(1, 2))
+
+
+def pose_to_transform(pose: torch.Tensor):
+    """
+    (B, 7) -> (B, 3, 4) [R | t].
+    """
+    return torch.cat([quat_to_mat(pose[:, :4]), pose[:, 4:].unsqueeze(2)], dim=2)
+
+
+def pose_to_mat4(pose: torch.Tensor):
+    """
+    (B, 7) -> (B, 4, 4) homogeneous transformation.
+    """
+    mat = pose.new_zeros(pose.shape[0], 4, 4)
+    mat[:, :3, :3] = quat_to_mat(pose[:, :4])
+    mat[:, :3, 3] = pose[:, 4:]
+    mat[:, 3, 3] = 1
+    return mat
+
+
+def mat4_to_pose(mat: torch.Tensor):
+    """
+    (B, 4, 4) or (B, 3, 4) -> (B, 7).
+    """
+    return torch.cat([mat_to_quat(mat[:, :3, :3]), mat[:, :3, 3]], dim=1)
@@ -0,0 +1,250 @@
+import sys
+import json
+import time
+import threading
+import bisect
+import itertools
+import collections
+import torch
+import torch.nn as nn
+from . import pose
+
+# Opt-in 逐模块 profiler: with 块内给子模块挂 forward hook, 并把自由函数 (knn, batch_norm_, pose.* 等) 换成计时包装.
+# 每次调用记录墙钟时间, 输出字节数 (out) 和调用期间分配的字节数 (alloc, 含子调用):
+# CUDA 上是 memory_allocated 的增量, CPU 上来自 torch.profiler 的 [memory] 事件. 可导出为 Chrome trace.
+#   with ModuleProfiler(model) as prof:
+#       model(source, template)
+#   prof.print_table(); prof.export_chrome_trace('trace.json')
+
+Event = collections.namedtuple('Event', ['name', 'kind', 'tid', 'start', 'duration', 'self_time',
+                                         'depth', 'out_bytes', 'alloc_bytes'])
+
+
+def _tensor_bytes(output):
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(_tensor_bytes(o) for o in output)
+    if isinstance(output, dict):
+        return sum(_tensor_bytes(o) for o in output.values())
+    return 0
+
+
+def default_functions(model):
+    # [(owner, attribute, label)]: 模型所在模块的 kNN / 邻域 / BN 函数, quaternion_rotate 和位姿更新
+    functions = []
+    module = sys.modules.get(type(model).__module__)
+    # batch_norm_: no_grad eval 下 BN 走 workspace 版本, 不会触发 BN 模块的 forward hook
+    for name in ('knn', 'get_neighbors', 'project_gather', 'project_gather_activated', 'batch_norm_'):
+        if callable(getattr(module, name, None)):
+            functions.append((module, name, name))
+    if callable(getattr(type(model), 'quaternion_rotate', None)):
+        functions.append((type(model), 'quaternion_rotate', 'quaternion_rotate'))
+    functions.append((pose, 'transform_points', 'pose.transform_points'))
+    functions.append((pose, 'compose', 'pose.compose'))
+    return functions
+
+
+def default_modules(model: nn.Module, depth=2):
+    # 根模块加上名字层级 <= depth 的子模块, 例如 feature_model, feature_model.pa_layer1, fc
+    modules = [(type(model).__name__, model)]
+    for name, module in model.named_modules():
+        if name and name.count('.') < depth:
+            modules.append((name, module))
+    return modules
+
+
+class ModuleProfiler:
+    def __init__(self, model: nn.Module, modules=None, functions=None, synchronize=None, memory=True):
+        # modules / functions: 默认 default_modules(model) / default_functions(model)
+        # synchronize: 每个事件前后 torch.cuda.synchronize, 模型在 CUDA 上时默认开启
+        # memory: CPU 上用 torch.profiler 记录每次调用分配的字节数 (更慢)
+        self.modules = default_modules(model) if modules is None else list(modules)
+        self.functions = default_functions(model) if functions is None else list(functions)
+        if synchronize is None:
+            synchronize = any(p.is_cuda for p in model.parameters())
+        self.cuda = synchronize and torch.cuda.is_available()
+        self.memory = memory and not self.cuda
+        self._kineto = None
+        self._keys = []
+        self._ids = itertools.count()
+        self.events = []
+        self._handles = []
+        self._originals = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin = None
+
+    # ---- 事件栈 (每个线程一个) ----
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _push(self, name, kind):
+        if self.cuda:
+            torch.cuda.synchronize()
+        alloc = torch.cuda.memory_allocated() if self.cuda else None
+        record = None
+        if self._kineto is not None:
+            # 唯一的 annotation 名, 退出时据此找回这次调用的时间区间
+            record = torch.autograd.profiler.record_function('{}#{}'.format(name, next(self._ids)))
+            record.__enter__()
+        # [name, kind, start, child_time, alloc_at_start, record_function]
+        self._stack().append([name, kind, time.perf_counter(), 0.0, alloc, record])
+
+    def _pop(self, output):
+        if self.cuda:
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        stack = self._stack()
+        if not stack:
+            return
+        name, kind, start, child_time, alloc, record = stack.pop()
+        if record is not None:
+            record.__exit__(None, None, None)
+        duration = end - start
+        if stack:
+            stack[-1][3] += duration
+        alloc_bytes = torch.cuda.memory_allocated() - alloc if alloc is not None else None
+        event = Event(name, kind, threading.get_ident(), start - self._origin, duration, duration - child_time,
+                      len(stack), _tensor_bytes(output), alloc_bytes)
+        with self._lock:
+            self.events.append(event)
+            self._keys.append(record.name if record is not None else None)
+
+    # ---- 安装 / 卸载 ----
+    def _wrap(self, fn, label):
+        profiler = self
+
+        def wrapper(*args, **kwargs):
+            profiler._push(label, 'function')
+            output = None
+            try:
+                output = fn(*args, **kwargs)
+                return output
+            finally:
+                profiler._pop(output)
+        wrapper.__wrapped__ = fn
+        return wrapper
+
+    def __enter__(self):
+        self.events, self._keys = [], []
+        if self.memory:
+            from torch.profiler import profile, ProfilerActivity
+            self._kineto = profile(activities=[ProfilerActivity.CPU], profile_memory=True)
+            self._kineto.__enter__()
+        self._origin = time.perf_counter()
+        for label, module in self.modules:
+            self._handles.append(module.register_forward_pre_hook(
+                lambda m, inputs, label=label: self._push(label, 'module')))
+            self._handles.append(module.register_forward_hook(
+                lambda m, inputs, output: self._pop(output)))
+        for owner, attr, label in self.functions:
+            raw = vars(owner).get(attr, getattr(owner, attr))    # 保留 staticmethod 包装
+            self._originals.append((owner, attr, raw))
+            if isinstance(raw, staticmethod):
+                setattr(owner, attr, staticmethod(self._wrap(raw.__func__, label)))
+            else:
+                setattr(owner, attr, self._wrap(raw, label))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for handle in self._handles:
+            handle.remove()
+        for owner, attr, raw in reversed(self._originals):
+            setattr(owner, attr, raw)
+        self._handles, self._originals = [], []
+        self._local = threading.local()     # 异常退出时丢弃未闭合的事件
+        if self._kineto is not None:
+            kineto, self._kineto = self._kineto, None
+            kineto.__exit__(exc_type, exc_value, traceback)
+            self._attribute_memory(kineto)
+        return False
+
+    def _attribute_memory(self, kineto):
+        # 每个线程的分配事件按时间排序 + 前缀和, 每次调用的 alloc = 区间 [start, end] 内分配字节之和
+        keys = set(k for k in self._keys if k is not None)
+        spans, allocs = {}, collections.defaultdict(list)
+        for e in kineto.profiler.kineto_results.events():
+            if e.name() == '[memory]':
+                if e.nbytes() > 0:
+                    allocs[e.start_thread_id()].append((e.start_ns(), e.nbytes()))
+            elif e.name() in keys:
+                spans[e.name()] = (e.start_thread_id(), e.start_ns(), e.start_ns() + e.duration_ns())
+        prefix = {}
+        for tid, items in allocs.items():
+            items.sort()
+            prefix[tid] = ([t for t, _ in items], [0] + list(itertools.accumulate(n for _, n in items)))
+        for i, key in enumerate(self._keys):
+            if key not in spans:
+                continue
+            tid, start, end = spans[key]
+            times, sums = prefix.get(tid, ([], [0]))
+            alloc = sums[bisect.bisect_right(times, end)] - sums[bisect.bisect_left(times, start)]
+            self.events[i] = self.events[i]._replace(alloc_bytes=alloc)
+
+    # ---- 结果 ----
+    def summary(self):
+        # 按名字汇总, 按总时间排序
+        rows = collections.OrderedDict()
+        for e in self.events:
+            row = rows.setdefault(e.name, {'name': e.name, 'kind': e.kind, 'calls': 0, 'total_ms': 0.0,
+                                           'self_ms': 0.0, 'out_bytes': 0, 'alloc_bytes': None})
+            row['calls'] += 1
+            row['total_ms'] += e.duration * 1e3
+            row['self_ms'] += e.self_time * 1e3
+            row['out_bytes'] += e.out_bytes
+            if e.alloc_bytes is not None:
+                row['alloc_bytes'] = (row['alloc_bytes'] or 0) + e.alloc_bytes
+        rows = sorted(rows.values(), key=lambda r: r['total_ms'], reverse=True)
+        for row in rows:
+            row['mean_ms'] = row['total_ms'] / row['calls']
+        return rows
+
+    def print_table(self, limit=None):
+        # self 时间去掉了嵌套在内部的已记录事件, 各行 self 之和约等于最外层事件的总时间
+        root = sum(e.duration for e in self.events if e.depth == 0) * 1e3
+        print("{:<32} {:>9} {:>6} {:>11} {:>10} {:>10} {:>7} {:>11} {:>11}".format(
+            'name', 'kind', 'calls', 'total(ms)', 'self(ms)', 'mean(ms)', 'self%', 'out(MB)', 'alloc(MB)'))
+        for row in self.summary()[:limit]:
+            alloc = '-' if row['alloc_bytes'] is None else '{:.1f}'.format(row['alloc_bytes'] / 2 ** 20)
+            print("{:<32} {:>9} {:>6} {:>11.2f} {:>10.2f} {:>10.3f} {:>6.1f}% {:>11.1f} {:>11}".format(
+                row['name'], row['kind'], row['calls'], row['total_ms'], row['self_ms'], row['mean_ms'],
+                100 * row['self_ms'] / root if root > 0 else 0.0, row['out_bytes'] / 2 ** 20, alloc))
+
+    def chrome_trace(self):
+        trace = []
+        for e in self.events:
+            args = {'out_bytes': e.out_bytes}
+            if e.alloc_bytes is not None:
+                args['alloc_bytes'] = e.alloc_bytes
+            trace.append({'name': e.name, 'cat': e.kind, 'ph': 'X', 'pid': 0, 'tid': e.tid,
+                          'ts': e.start * 1e6, 'dur': e.duration * 1e6, 'args': args})
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def count_allocations(fn, *args, **kwargs):
+    # 在 torch.profiler(profile_memory=True) 下运行一次 fn, 统计分配器调用: (result, {allocations, alloc_bytes, frees})
+    from torch.profiler import profile, ProfilerActivity
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities, profile_memory=True) as prof:
+        result = fn(*args, **kwargs)
+    counts = {'allocations': 0, 'alloc_bytes': 0, 'frees': 0}
+    # 每次分配 / 释放都是一个 name 为 '[memory]' 的事件, nbytes 为正表示分配
+    for e in prof.profiler.kineto_results.events():
+        if e.name() != '[memory]':
+            continue
+        if e.nbytes() > 0:
+            counts['allocations'] += 1
+            counts['alloc_bytes'] += e.nbytes()
+        elif e.nbytes() < 0:
+            counts['frees'] += 1
+    return result, counts
@@ -8,6 +8,8 @@
 import torch
 import numpy as np
 from scipy.spatial.transform import Rotation
+from . import pose
+from . import metrics
 # PyTorch-backed implementations
 
 def torch_qmul(q1, q2):
@@ -63,68 +65,29 @@ def torch_qrot(q, v):
 
 # PANet代码：修改过
 def torch_transform_pose(pose_old, pose_new):
-    quat_old, translate_old = pose_old[:, :4], pose_old[:, 4:]
-    quat_new, translate_new = pose_new[:, :4], pose_new[:, 4:]
-
-    quat = torch_qmul(quat_new, quat_old)
-    translate = torch_qrot(quat_new, translate_old) + translate_new
-    pose = torch.cat((quat, translate), dim=1)
-
-    return pose
+    # torch_qmul(q_new, q_old) 即 q_old * q_new; translate = R_new * t_old + t_new
+    quat = pose.qmul(pose_old[:, :4], pose_new[:, :4])
+    translate = pose.qrot(pose_new[:, :4], pose_old[:, 4:]) + pose_new[:, 4:]
+    return torch.cat((quat, translate), dim=1)
 
 def torch_quat_rotate(point_cloud: torch.Tensor, pose_7d: torch.Tensor):
-    ndim = point_cloud.dim()
-    if ndim == 2:
-        N, _ = point_cloud.shape
-        assert pose_7d.shape[0] == 1
-        # repeat transformation vector for each point in shape
-        quat = pose_7d[:, 0:4].expand([N, -1])
-        rotated_point_cloud = torch_qrot(quat, point_cloud)
-
-    elif ndim == 3:
-        B, N, _ = point_cloud.shape
-        quat = pose_7d[:, 0:4].unsqueeze(1).expand([-1, N, -1]).contiguous()
-        rotated_point_cloud = torch_qrot(quat, point_cloud)
-
-    else:
+    if point_cloud.dim() not in (2, 3):
         raise RuntimeError("point cloud dim must be 2 or 3 !")
-
-    return rotated_point_cloud
+    return pose.rotate_points(pose_7d, point_cloud)
 
 # pc: (B, N, 3)
 def torch_quat_transform(pose_7d: torch.Tensor, pc: torch.Tensor, normal: torch.Tensor = None):
-    pc_t = torch_quat_rotate(pc, pose_7d) + pose_7d[:, 4:].view(-1, 1, 3).repeat(1, pc.shape[1], 1)  # Ps" = R*Ps + t
-    return pc_t
+    return pose.transform_points(pose_7d, pc)  # Ps" = R*Ps + t
 
-def torch_quat2mat(pose):
-    # Separate each quaternion value.
-    q0, q1, q2, q3 = pose[:, 0], pose[:, 1], pose[:, 2], pose[:, 3]
+def torch_quat2mat(pose_7d):
     # Convert quaternion to rotation matrix.
     # Ref: 	http://www-evasion.inrialpes.fr/people/Franck.Hetroy/Teaching/ProjetsImage/2007/Bib/besl_mckay-pami1992.pdf
     # A method for Registration of 3D shapes paper by Paul J. Besl and Neil D McKay.
-    R11 = q0 * q0 + q1 * q1 - q2 * q2 - q3 * q3
-    R12 = 2 * (q1 * q2 - q0 * q3)
-    R13 = 2 * (q1 * q3 + q0 * q2)
-    R21 = 2 * (q1 * q2 + q0 * q3)
-    R22 = q0 * q0 + q2 * q2 - q1 * q1 - q3 * q3
-    R23 = 2 * (q2 * q3 - q0 * q1)
-    R31 = 2 * (q1 * q3 - q0 * q2)
-    R32 = 2 * (q2 * q3 + q0 * q1)
-    R33 = q0 * q0 + q3 * q3 - q1 * q1 - q2 * q2
-    R = torch.stack((torch.stack((R11, R12, R13), dim=0), torch.stack((R21, R22, R23), dim=0), torch.stack((R31, R32, R33), dim=0)), dim=0)
-
-    rot_mat = R.permute((2, 0, 1))  # (B, 3, 3)
-    translation = pose[:, 4:].unsqueeze(2)  # (B, 3, 1)
-    transform = torch.cat((rot_mat, translation), dim=2)
-    return transform  # (B, 3, 4)
+    return pose.pose_to_transform(pose_7d)  # (B, 3, 4)
 
 def mat2euler(mats, seq='zyx'):
-    eulers = torch.tensor([])
-    for i in range(mats.size(0)):
-        r = Rotation.from_matrix(mats[i].detach().cpu().numpy())
-        temp = torch.tensor(r.as_euler(seq, degrees=False)).view(1, 3)[:, [2, 1, 0]]
-        eulers = torch.cat((eulers, temp), dim=0)
-    return eulers
+    # (B, 3, 3) -> (B, 3) [x, y, z], 批量计算且留在原 device 上, 见 ops/metrics.py
+    return metrics.mat2euler(mats.detach(), seq)
 
 def qmul(q, r):
     """
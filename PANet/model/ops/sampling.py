@@ -0,0 +1,100 @@
+import torch
+
+# 点云下采样到固定点数 (point budget). 输入输出均为 (B, N, 3), 同一 batch 内的点数必须相同.
+# 'fps'   : 最远点采样, O(budget * N)
+# 'voxel' : 先体素网格 (每个体素取质心) 把点数降到 budget ~ 2 * budget 之间, 再对体素质心做 FPS 得到恰好 budget 个点,
+#           FPS 的代价与输入密度无关
+# 'random': 均匀随机子集
+# 'fps' / 'voxel' 不会重复取点: 点云的不同点数少于 budget 时, 输出点数截断到 batch 内最少的不同点数,
+# 否则重复点会让下一层 kNN 找到距离为 0 的邻居.
+
+
+def farthest_point_sample(points, num_samples, generator=None, return_distinct=False):
+    """
+    Batched farthest point sampling. points: (B, N, 3) -> indices (B, num_samples).
+    The first point of every cloud is chosen at random.
+    return_distinct: also return (B,) the number of leading indices that are distinct points.
+    """
+    B, N, _ = points.shape
+    idx = torch.empty(B, num_samples, dtype=torch.long, device=points.device)
+    min_dist = torch.full((B, N), float('inf'), dtype=points.dtype, device=points.device)
+    farthest = torch.randint(N, (B,), generator=generator).to(points.device)
+    batch = torch.arange(B, device=points.device)
+    distinct = torch.ones(B, dtype=torch.long, device=points.device)
+    for i in range(num_samples):
+        idx[:, i] = farthest
+        if i > 0:
+            # 选中点到已选集合的距离单调不增, 为 0 之后取到的都是重复点
+            distinct += min_dist[batch, farthest] > 0
+        centroid = points[batch, farthest].unsqueeze(1)                  # (B, 1, 3)
+        torch.minimum(min_dist, (points - centroid).pow(2).sum(dim=-1), out=min_dist)
+        farthest = min_dist.argmax(dim=1)
+    if return_distinct:
+        return idx, distinct
+    return idx
+
+
+def voxel_downsample(points, voxel_size):
+    """
+    Centroid of the points in every occupied voxel of one cloud. points: (N, 3) -> (M, 3).
+    """
+    coords = torch.floor((points - points.min(dim=0)[0]) / voxel_size).long()     # (N, 3)
+    _, inverse, counts = torch.unique(coords, dim=0, return_inverse=True, return_counts=True)
+    centroids = points.new_zeros(counts.shape[0], 3).index_add_(0, inverse, points)
+    return centroids / counts.unsqueeze(1).to(points)
+
+
+def _voxel_budget(points, budget, slack=2.0, max_steps=32):
+    """
+    Voxel centroids of one cloud (N, 3): at least `budget` of them, and within max_steps searches at most
+    slack * budget, so the FPS that follows costs O(budget^2) whatever the density of the input.
+    Never returns the raw cloud; if it has fewer than `budget` distinct points, the finest grid is used.
+    """
+    # 扫描点云是曲面, 体素数 ~ 表面积 / voxel_size^2; 初始大小用包围盒的表面积估计
+    ex, ey, ez = (points.max(dim=0)[0] - points.min(dim=0)[0]).clamp(min=1e-6).tolist()
+    voxel_size = (2 * (ex * ey + ey * ez + ez * ex) / budget) ** 0.5
+    # 在 "体素数 >= budget" (fine) 与 "< budget" (coarse) 的尺寸之间按几何平均二分
+    fine, coarse, best = None, None, None
+    for _ in range(max_steps):
+        down = voxel_downsample(points, voxel_size)
+        if down.shape[0] >= budget:
+            fine, best = voxel_size, down
+            if down.shape[0] <= slack * budget:
+                break
+        else:
+            coarse = voxel_size
+        if fine is None:
+            voxel_size = coarse / 2
+        elif coarse is None:
+            voxel_size = fine * 2
+        else:
+            voxel_size = (fine * coarse) ** 0.5
+    return down if best is None else best
+
+
+def downsample(points, budget, method='voxel', generator=None):
+    """
+    Resample every cloud of points (B, N, 3) to `budget` points. Clouds that already have at most `budget`
+    points are returned unchanged. 'fps' and 'voxel' return fewer points when a cloud of the batch has fewer
+    than `budget` distinct points, instead of repeating some.
+    """
+    B, N, _ = points.shape
+    if N <= budget:
+        return points
+    if method == 'random':
+        idx = torch.rand(B, N, generator=generator).argsort(dim=1)[:, :budget].to(points.device)
+        return torch.gather(points, 1, idx.unsqueeze(-1).expand(-1, -1, 3))
+    if method == 'fps':
+        idx, distinct = farthest_point_sample(points, budget, generator, return_distinct=True)
+        idx = idx[:, :int(distinct.min())]
+        return torch.gather(points, 1, idx.unsqueeze(-1).expand(-1, -1, 3))
+    if method == 'voxel':
+        # 不同体素的质心互不相同, 体素数不足 budget 时整个 batch 截断到最少的体素数
+        downs = [_voxel_budget(points[b], budget) for b in range(B)]
+        budget = min([budget] + [down.shape[0] for down in downs])
+        out = points.new_empty(B, budget, 3)
+        for b, down in enumerate(downs):
+            idx = farthest_point_sample(down.unsqueeze(0), budget, generator)[0]
+            out[b] = down[idx]
+        return out
+    raise ValueError("unknown downsampling method: {}".format(method))
@@ -1,25 +1,67 @@
+import os
 import numpy as np
 import torch
 import torch.nn.functional as F
 from scipy.spatial.transform import Rotation
-from scipy.spatial.distance import minkowski
-from sklearn.neighbors import NearestNeighbors
 from . import quaternion
+from . import pose
+from . import metrics
+from .cloud_io import memmap_npy
 
 # Create Partial Point Cloud. [Code referred from PRNet paper.]
+# 原实现用 sklearn NearestNeighbors(metric=lambda x, y: minkowski(x, y)), 每个点对都要回调一次 Python 函数.
+# 这里直接向量化计算到锚点的距离, 再用 topk / argpartition 取最近的 num_subsampled_points 个点.
+def _random_anchors(batch_size, rng):
+    # 与原实现相同: [0, 1)^3 + 500 * (±1), 即远离点云的随机锚点
+    if isinstance(rng, torch.Generator):
+        sign = torch.randint(0, 2, (batch_size, 1), generator=rng, dtype=torch.float64) * 2 - 1
+        return (torch.rand((batch_size, 3), generator=rng, dtype=torch.float64) + 500.0 * sign).numpy()
+    # np.random.RandomState 和全局 np.random 模块只有 random_sample (旧版 numpy 没有 .random)
+    uniform = rng.random if isinstance(rng, np.random.Generator) else rng.random_sample
+    return uniform((batch_size, 3)) + 500.0 * rng.choice([1, -1], size=(batch_size, 1))
+
+
 # def farthest_subsample_points(source_cloud, num_subsampled_points=1536):
-def farthest_subsample_points(source_cloud, num_subsampled_points=768):
-    source = source_cloud
-    num_points = source.shape[0]    # 1024*3
-    # nbrs: 768*3
-    nbrs1 = NearestNeighbors(n_neighbors=num_subsampled_points, algorithm='auto',
-                             metric=lambda x, y: minkowski(x, y)).fit(source[:, :3])
-    # np.random.random(size=(1, 3)) 产生[0,1)之间大小为 1*3 的浮点数
-    # random_p1: -499.xx or 500.xx
-    random_p1 = np.random.random(size=(1, 3)) + np.array([[500, 500, 500]]) * np.random.choice([1, -1, 1, -1])
-    idx1 = nbrs1.kneighbors(random_p1, return_distance=False).reshape((num_subsampled_points,))
-    gt_mask = torch.zeros(num_points).scatter_(0, torch.tensor(idx1), 1)
-    return source[idx1, :], gt_mask
+def farthest_subsample_points(source_cloud, num_subsampled_points=768, rng=None):
+    """
+    Partial cloud made of the num_subsampled_points points nearest to a random far-away anchor.
+    source_cloud: (N, C) or (B, N, C) ndarray/tensor, distances use the first 3 channels.
+    rng: np.random.Generator, np.random.RandomState, torch.Generator or int seed; None uses the global
+    np.random state.
+    Returns (points, gt_mask): points (…, num_subsampled_points, C) of the input's type, sorted by
+    distance to the anchor, and a float tensor gt_mask (…, N) marking the kept points.
+    """
+    if rng is None:
+        rng = np.random
+    elif not isinstance(rng, (np.random.Generator, np.random.RandomState, torch.Generator)):
+        rng = np.random.default_rng(rng)
+    single = source_cloud.ndim == 2
+    source = source_cloud[None] if single else source_cloud     # (B, N, C)
+    B, N, _ = source.shape
+    anchors = _random_anchors(B, rng)                           # (B, 3)
+
+    if isinstance(source, torch.Tensor):
+        # float64: 锚点距离约 866, float32 下平方距离的分辨率不够区分相邻点
+        xyz = source[:, :, :3].detach().double()
+        dist = (xyz - torch.from_numpy(anchors).to(xyz.device).unsqueeze(1)).pow(2).sum(dim=-1)   # (B, N)
+        idx = dist.topk(num_subsampled_points, dim=1, largest=False, sorted=True)[1]               # (B, k)
+        points = torch.gather(source, 1, idx.unsqueeze(-1).expand(-1, -1, source.shape[2]))
+        idx = idx.cpu()
+    else:
+        dist = np.square(source[:, :, :3] - anchors[:, None, :]).sum(axis=-1)                      # (B, N)
+        if num_subsampled_points < N:
+            idx = np.argpartition(dist, num_subsampled_points - 1, axis=1)[:, :num_subsampled_points]
+        else:
+            idx = np.broadcast_to(np.arange(N), (B, N))
+        order = np.argsort(np.take_along_axis(dist, idx, axis=1), axis=1)
+        idx = np.take_along_axis(idx, order, axis=1)                                               # (B, k)
+        points = np.take_along_axis(source, idx[:, :, None], axis=1)
+        idx = torch.from_numpy(idx)
+
+    gt_mask = torch.zeros(B, N).scatter_(1, idx, 1)
+    if single:
+        return points[0], gt_mask[0]
+    return points, gt_mask
 
 # def jitter_pointcloud(source_cloud1, sigma=0.01, clip=0.05):
 #     # N, C = pointcloud.shape
@@ -165,58 +207,84 @@ def euler_to_quaternion(e, order):
     return result.reshape(original_shape)
 
 def npmat2euler(mats, seq='zyx'):
-    """ return euler angles in radian """
-    eulers = []
-    r = Rotation.from_matrix(mats)
-    eulers.append(r.as_euler(seq, degrees=False))
-    return np.asarray(eulers, dtype='float32')
+    """ return euler angles in radian, in scipy's as_euler(seq) order """
+    mats = np.asarray(mats, dtype=np.float64)
+    eulers = metrics.mat2euler(torch.from_numpy(mats.reshape(-1, 3, 3)), seq).numpy()[:, [2, 1, 0]]
+    return np.asarray([eulers[0] if mats.ndim == 2 else eulers], dtype='float32')
 
 def mat2euler(mats, seq='zyx'):
-    eulers = torch.tensor([])
-    for i in range(mats.size(0)):
-        r = Rotation.from_matrix(mats[i])
-        temp = torch.tensor(r.as_euler(seq, degrees=False)).view(1, 3)[:, [2, 1, 0]]
-        eulers = torch.cat((eulers, temp), dim=0)
-    return eulers
+    # (B, 3, 3) -> (B, 3) [x, y, z], 见 ops/metrics.py
+    return metrics.mat2euler(torch.as_tensor(mats), seq)
 
 class PCRNetTransform:
     # def __init__(self, data_size, angle_range=45, translation_range=0.5):
-    def __init__(self, data_size, angle_range=45, translation_range=0.12):
+    def __init__(self, data_size, angle_range=45, translation_range=0.12, rng=None, path=None):
+        """
+        rng: np.random.Generator, np.random.RandomState or int seed for the bank; None uses the global np.random state.
+        path: .npy transform bank; loaded (memory-mapped) if it exists, otherwise generated and saved there.
+        """
         self.angle_range = angle_range
         self.translation_range = translation_range
         self.dtype = torch.float32
-        # self.transformations: 9840 * (1, 7): 初始化9840个变换参数
-        self.transformations = [self.create_random_transform(torch.float32, self.angle_range, self.translation_range) for _ in range(data_size)]
+        # self.transformations: (9840, 7): 一次性生成 9840 个变换参数, 连续存放
+        if path is not None and os.path.exists(path):
+            self.transformations = self.load(path)
+            if self.transformations.shape[0] != data_size:
+                raise ValueError("transform bank {} has {} entries, expected {}".format(
+                    path, self.transformations.shape[0], data_size))
+        else:
+            self.transformations = self.create_random_transforms(data_size, self.dtype, self.angle_range,
+                                                                 self.translation_range, rng)
+            if path is not None:
+                self.save(path)
         self.index = 0
 
+    def __len__(self):
+        return self.transformations.shape[0]
+
     @staticmethod
     def deg_to_rad(deg):
         return np.pi / 180 * deg
 
-    # 由欧拉角到四元数再归一化
-    def create_random_transform(self, dtype, max_rotation_deg, max_translation):
-        max_rotation = self.deg_to_rad(max_rotation_deg)    # 角度转弧度
-        # euler = np.random.uniform(-max_rotation, max_rotation, [1, 3])    # ndarray(1,3) 真实弧度制欧拉角
-        euler = np.random.uniform(0, max_rotation, [1, 3])    # ndarray(1,3) 真实弧度制欧拉角
-        # print("ground truth euler angles in radian:\n", rot)
-        trans = np.random.uniform(-max_translation, max_translation, [1, 3])
+    # 由欧拉角到四元数再归一化, 整个 bank 一次向量化生成
+    @classmethod
+    def create_random_transforms(cls, num, dtype, max_rotation_deg, max_translation, rng=None):
+        if rng is None:
+            rng = np.random
+        elif not isinstance(rng, (np.random.Generator, np.random.RandomState)):
+            rng = np.random.default_rng(rng)
+        max_rotation = cls.deg_to_rad(max_rotation_deg)    # 角度转弧度
+        # euler = rng.uniform(-max_rotation, max_rotation, [num, 3])
+        euler = rng.uniform(0, max_rotation, [num, 3])    # ndarray(num, 3) 真实弧度制欧拉角
+        trans = rng.uniform(-max_translation, max_translation, [num, 3])
         quat = euler_to_quaternion(euler, "xyz")  # 返回的是已经归一化的结果
 
         vec = np.concatenate([quat, trans], axis=1)
-        vec = torch.tensor(vec, dtype=dtype)
-        return vec
+        return torch.tensor(vec, dtype=dtype)     # (num, 7)
+
+    def create_random_transform(self, dtype, max_rotation_deg, max_translation):
+        return self.create_random_transforms(1, dtype, max_rotation_deg, max_translation)   # (1, 7)
     # -----end init-----
 
+    def save(self, path):
+        # 以 .npy 格式写出, 之后可以用 mmap 直接映射, 保证不同 epoch / 不同进程用同一组变换.
+        # 先写临时文件再 os.replace, 其它进程不会读到写了一半的文件
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        bank = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=tuple(self.transformations.shape))
+        bank[:] = self.transformations.numpy()
+        bank.flush()
+        del bank
+        os.replace(tmp, path)
+
     @staticmethod
-    def create_pose_7d(vector: torch.Tensor):
-        # Normalize the quaternion.
-        pre_normalized_quaternion = vector[:, 0:4]
-        normalized_quaternion = F.normalize(pre_normalized_quaternion, dim=1)
+    def load(path):
+        # mmap_mode='c': copy-on-write, 文件不会被改写, torch.from_numpy 也不需要额外拷贝, 见 ops/cloud_io.py
+        return memmap_npy(path)
 
-        # B x 7 vector of 4 quaternions and 3 translation parameters
-        translation = vector[:, 4:]
-        vector = torch.cat([normalized_quaternion, translation], dim=1)
-        return vector.view([-1, 7])
+    @staticmethod
+    def create_pose_7d(vector: torch.Tensor):
+        # Normalize the quaternion. B x 7 vector of 4 quaternions and 3 translation parameters
+        return pose.normalize_pose(vector)
 
     @staticmethod
     def get_quaternion(pose_7d: torch.Tensor):
@@ -228,29 +296,14 @@ class PCRNetTransform:
 
     @staticmethod
     def quaternion_rotate(point_cloud: torch.Tensor, pose_7d: torch.Tensor):
-        ndim = point_cloud.dim()    # 判断输入数据是几维的, 若是(N, C)则ndim=2, 若是(B, N, C)则ndim=3
-        # 生成真实值
-        if ndim == 2:
-            N, _ = point_cloud.shape
-            assert pose_7d.shape[0] == 1
-            # repeat transformation vector for each point in shape
-            quat = PCRNetTransform.get_quaternion(pose_7d).expand([N, -1])  # (N, 4)
-            rotated_point_cloud = quaternion.qrot(quat, point_cloud)
-
-        # 生成预测值
-        elif ndim == 3:
-            B, N, _ = point_cloud.shape
-            quat = PCRNetTransform.get_quaternion(pose_7d).unsqueeze(1).expand([-1, N, -1]).contiguous()    # (B, N, 4)
-            rotated_point_cloud = quaternion.qrot(quat, point_cloud)
-        else:
+        # point_cloud: (N, C) 配合 (1, 7) 的 pose, 或 (B, N, C) 配合 (B, 7)
+        if point_cloud.dim() not in (2, 3):
             raise ValueError("quaternion_rotate dims error")
-
-        return rotated_point_cloud
+        return pose.rotate_points(pose_7d, point_cloud)
 
     @staticmethod
     def quaternion_transform(point_cloud: torch.Tensor, pose_7d: torch.Tensor):
-        transformed_point_cloud = PCRNetTransform.quaternion_rotate(point_cloud, pose_7d) + PCRNetTransform.get_translation(pose_7d).view(-1, 1, 3).repeat(1, point_cloud.shape[1], 1)      # Ps' = R*Ps + t
-        return transformed_point_cloud
+        return pose.transform_points(pose_7d, point_cloud)      # Ps' = R*Ps + t
 
     @staticmethod
     def convert2transformation(rotation_matrix: torch.Tensor, translation_vector: torch.Tensor):
@@ -259,17 +312,21 @@ class PCRNetTransform:
         transformation_matrix = torch.cat([transformation_matrix, one_], dim=1)                                     # (Bx4x4)
         return transformation_matrix
 
-    # template: (1024, 3)
-    def __call__(self, template):   # 检验过，全部正确
-        self.igt = self.transformations[self.index]     # (1, 7)
-        igt = self.create_pose_7d(self.igt)     # F.normalize: 归一化后的pose_7d
-        gt_quat = igt[:, :4].squeeze(dim=0)
-        gt_trans = igt[:, 4:].squeeze(dim=0)
+    # template: (1024, 3) 使用第 self.index 个变换; 或 (B, 1024, 3) 配合 B 个下标 indices
+    def __call__(self, template, indices=None):   # 检验过，全部正确
+        if template.dim() == 3:
+            if indices is None:
+                indices = torch.arange(self.index, self.index + template.shape[0]) % len(self)
+            self.igt = self.transformations[torch.as_tensor(indices, dtype=torch.long)]     # (B, 7)
+        else:
+            self.igt = self.transformations[self.index:self.index + 1]     # (1, 7)
+        igt = self.create_pose_7d(self.igt).to(template)     # F.normalize: 归一化后的pose_7d
 
-        source = self.quaternion_rotate(template, igt) + self.get_translation(igt)
-        gt_rot = self.quaternion_rotate(torch.eye(3), igt).permute(1, 0)            # (3, 3)
-        gt_T = torch.cat([gt_rot, gt_trans.unsqueeze(dim=0).permute(1, 0)], dim=1)  # (3, 4)
-        return source, gt_quat, gt_trans, gt_T  # source: (1024, 3), gt_quat: (4), gt_trans: (3)
+        source = pose.transform_points(igt, template)
+        gt_T = pose.pose_to_transform(igt)      # (B, 3, 4)
+        if template.dim() == 3:
+            return source, igt[:, :4], igt[:, 4:], gt_T  # source: (B, 1024, 3), gt_quat: (B, 4), gt_trans: (B, 3)
+        return source, igt[0, :4], igt[0, 4:], gt_T[0]  # source: (1024, 3), gt_quat: (4), gt_trans: (3)
 
 
         # self.igt_rotation = self.quaternion_rotate(torch.eye(3), igt).permute(1, 0)        # 真实旋转矩阵("xyz"): [3x3]
@@ -279,93 +336,7 @@ class PCRNetTransform:
 
 
 
-class Generate_transformed_source:
-    def __init__(self, data_size, angle_range=0.5, translation_range=0.0005):
-        self.angle_range = angle_range
-        self.translation_range = translation_range
-        self.dtype = torch.float32
-        # self.transformations: 9840 * (1, 7): 初始化9840个变换参数
-        self.transformations = [self.create_random_transform(torch.float32, self.angle_range, self.translation_range) for _ in range(data_size)]
-        self.index = 0
-
-    @staticmethod
-    def deg_to_rad(deg):
-        return np.pi / 180 * deg
-
-    # 由欧拉角到四元数再归一化
-    def create_random_transform(self, dtype, max_rotation_deg, max_translation):
-        max_rotation = self.deg_to_rad(max_rotation_deg)    # 角度转弧度
-        # euler = np.random.uniform(-max_rotation, max_rotation, [1, 3])    # ndarray(1,3) 真实弧度制欧拉角
-        euler = np.random.uniform(0, max_rotation, [1, 3])    # ndarray(1,3) 真实弧度制欧拉角
-        # print("ground truth euler angles in radian:\n", rot)
-        trans = np.random.uniform(-max_translation, max_translation, [1, 3])
-        quat = euler_to_quaternion(euler, "xyz")  # 返回的是已经归一化的结果
-
-        vec = np.concatenate([quat, trans], axis=1)
-        vec = torch.tensor(vec, dtype=dtype)
-        return vec
-    # -----end init-----
-
-    @staticmethod
-    def create_pose_7d(vector: torch.Tensor):
-        # Normalize the quaternion.
-        pre_normalized_quaternion = vector[:, 0:4]
-        normalized_quaternion = F.normalize(pre_normalized_quaternion, dim=1)
-
-        # B x 7 vector of 4 quaternions and 3 translation parameters
-        translation = vector[:, 4:]
-        vector = torch.cat([normalized_quaternion, translation], dim=1)
-        return vector.view([-1, 7])
-
-    @staticmethod
-    def get_quaternion(pose_7d: torch.Tensor):
-        return pose_7d[:, 0:4]
-
-    @staticmethod
-    def get_translation(pose_7d: torch.Tensor):
-            return pose_7d[:, 4:]
-
-    @staticmethod
-    def quaternion_rotate(point_cloud: torch.Tensor, pose_7d: torch.Tensor):
-        ndim = point_cloud.dim()    # 判断输入数据是几维的, 若是(N, C)则ndim=2, 若是(B, N, C)则ndim=3
-        # 生成真实值
-        if ndim == 2:
-            N, _ = point_cloud.shape
-            assert pose_7d.shape[0] == 1
-            # repeat transformation vector for each point in shape
-            quat = PCRNetTransform.get_quaternion(pose_7d).expand([N, -1])  # (N, 4)
-            rotated_point_cloud = quaternion.qrot(quat, point_cloud)
-
-        # 生成预测值
-        elif ndim == 3:
-            B, N, _ = point_cloud.shape
-            quat = PCRNetTransform.get_quaternion(pose_7d).unsqueeze(1).expand([-1, N, -1]).contiguous()    # (B, N, 4)
-            rotated_point_cloud = quaternion.qrot(quat, point_cloud)
-        else:
-            raise ValueError("quaternion_rotate dims error")
-
-        return rotated_point_cloud
-
-    @staticmethod
-    def quaternion_transform(point_cloud: torch.Tensor, pose_7d: torch.Tensor):
-        transformed_point_cloud = PCRNetTransform.quaternion_rotate(point_cloud, pose_7d) + PCRNetTransform.get_translation(pose_7d).view(-1, 1, 3).repeat(1, point_cloud.shape[1], 1)      # Ps' = R*Ps + t
-        return transformed_point_cloud
-
-    @staticmethod
-    def convert2transformation(rotation_matrix: torch.Tensor, translation_vector: torch.Tensor):
-        one_ = torch.tensor([[[0.0, 0.0, 0.0, 1.0]]]).repeat(rotation_matrix.shape[0], 1, 1).to(rotation_matrix)    # (Bx1x4)
-        transformation_matrix = torch.cat([rotation_matrix, translation_vector[:,0,:].unsqueeze(-1)], dim=2)        # (Bx3x4)
-        transformation_matrix = torch.cat([transformation_matrix, one_], dim=1)                                     # (Bx4x4)
-        return transformation_matrix
-
-    # template: (1024, 3)
-    def __call__(self, template):   # 检验过，全部正确
-        self.igt = self.transformations[self.index]     # (1, 7)
-        igt = self.create_pose_7d(self.igt)     # F.normalize: 归一化后的pose_7d
-        gt_quat = igt[:, :4].squeeze(dim=0)
-        gt_trans = igt[:, 4:].squeeze(dim=0)
-
-        transformed_source = self.quaternion_rotate(template, igt) + self.get_translation(igt)
-        gt_rot = self.quaternion_rotate(torch.eye(3), igt).permute(1, 0)            # (3, 3)
-        gt_T = torch.cat([gt_rot, gt_trans.unsqueeze(dim=0).permute(1, 0)], dim=1)  # (3, 4)
-        return transformed_source, gt_quat, gt_trans, gt_T  # transformed_source: (768, 3), gt_quat: (4), gt_trans: (3)
\ No newline at end of file
+class Generate_transformed_source(PCRNetTransform):
+    # 与 PCRNetTransform 完全相同, 只是默认扰动范围很小 (0.5°, 0.0005)
+    def __init__(self, data_size, angle_range=0.5, translation_range=0.0005, rng=None, path=None):
+        super(Generate_transformed_source, self).__init__(data_size, angle_range, translation_range, rng, path)
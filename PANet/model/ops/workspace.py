@@ -0,0 +1,36 @@
+import torch
+
+# 可复用的缓冲区. 只用于不会离开当前调用的中间结果 (no_grad 推理, collate 中的临时张量),
+# 同一个 Workspace 不能被两个并发调用共用.
+
+
+class Workspace:
+    def __init__(self):
+        self._buffers = {}
+        self._memo = {}
+
+    def get(self, name, shape, dtype=torch.float32, device=None):
+        # 第一次使用时分配, 之后原样返回 (内容是上一次使用留下的)
+        key = (name, tuple(shape), dtype, torch.device('cpu') if device is None else torch.device(device))
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = self._buffers[key] = torch.empty(shape, dtype=dtype, device=key[3])
+        return buf
+
+    def index_base(self, batch_size, num_points, device=None):
+        # (B, 1, 1): 第 b 个点云在展平后的 (B * N) 下标中的起始位置
+        key = ('index_base', (batch_size, num_points), torch.long, torch.device('cpu') if device is None else torch.device(device))
+        base = self._buffers.get(key)
+        if base is None:
+            base = self._buffers[key] = (torch.arange(batch_size, device=key[3]) * num_points).view(-1, 1, 1)
+        return base
+
+    def memo(self, key, version, compute):
+        # 由参数导出的小张量 (例如 BN 的 scale / shift), version 变化时才重新 compute()
+        entry = self._memo.get(key)
+        if entry is None or entry[0] != version:
+            entry = self._memo[key] = (version, compute())
+        return entry[1]
+
+    def nbytes(self):
+        return sum(buf.numel() * buf.element_size() for buf in self._buffers.values())
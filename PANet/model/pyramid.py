@@ -0,0 +1,79 @@
+import time
+import argparse
+import torch
+import torch.nn as nn
+from PANet import PANet
+from ops import pose
+from ops.sampling import downsample
+
+# Coarse-to-fine pyramid registration for dense scans.
+# 每一层把 source / template 下采样到固定的点数预算, 最粗层从单位位姿开始跑 PANet,
+# 更细的层以上一层的位姿为初值 (init_pose) 只做少量 refinement 迭代.
+# 网络只看到预算内的点, 所以延迟基本与输入点数 (扫描密度) 无关, 只剩下采样本身 O(N) 的开销.
+
+
+class PyramidPANet(nn.Module):
+    def __init__(self, model: PANet, budgets=(1024, 2048), iters=(4, 2), method='voxel', seed=0):
+        """
+        budgets: points per level, coarse to fine. iters: PANet iterations per level.
+        method: 'voxel' | 'fps' | 'random', see ops/sampling.py.
+        """
+        super(PyramidPANet, self).__init__()
+        if len(budgets) != len(iters):
+            raise ValueError("budgets and iters must have the same length")
+        self.model = model
+        self.budgets = list(budgets)
+        self.iters = list(iters)
+        self.method = method
+        self.seed = seed
+
+    def forward(self, source, template):
+        generator = torch.Generator().manual_seed(self.seed)
+        # 由细到粗构建金字塔: 只有最细层需要处理全部 N 个点, 更粗的层从上一层的结果继续下采样
+        pyramid = []
+        src, tpl = source, template
+        for budget in reversed(self.budgets):
+            start = time.perf_counter()
+            src = downsample(src, budget, self.method, generator)
+            tpl = downsample(tpl, budget, self.method, generator)
+            pyramid.append((src, tpl, (time.perf_counter() - start) * 1e3))
+        pyramid.reverse()
+
+        pose_pred = None
+        levels = []
+        for (src, tpl, sample_ms), num_iter in zip(pyramid, self.iters):
+            start = time.perf_counter()
+            result = self.model(src, tpl, num_iter=num_iter, init_pose=pose_pred)
+            pose_pred = result['pose_pred']
+            levels.append({'num_points': src.shape[1], 'num_iter': num_iter, 'sample_ms': sample_ms,
+                           'register_ms': (time.perf_counter() - start) * 1e3})
+
+        return {'pose_pred': pose_pred,                                          # (B, 7)
+                'transform_pred': pose.pose_to_transform(pose_pred),             # (B, 3, 4)
+                'transformed_template': pose.transform_points(pose_pred, template),  # 全分辨率
+                'levels': levels}
+
+
+def main():
+    # 不同扫描密度下的延迟: 网络部分应基本不变
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_points', type=int, nargs='+', default=[1024, 10000, 100000])
+    parser.add_argument('--budgets', type=int, nargs='+', default=[1024, 2048])
+    parser.add_argument('--iters', type=int, nargs='+', default=[4, 2])
+    parser.add_argument('--method', default='voxel', choices=('voxel', 'fps', 'random'))
+    parser.add_argument('--batch_size', type=int, default=1)
+    args = parser.parse_args()
+
+    net = PyramidPANet(PANet().eval(), args.budgets, args.iters, args.method)
+    print("{:>8} {:>8} {:>12} {:>14} {:>10}".format('N', 'level', 'sample(ms)', 'register(ms)', 'points'))
+    for N in args.num_points:
+        source, template = torch.rand(args.batch_size, N, 3), torch.rand(args.batch_size, N, 3)
+        with torch.no_grad():
+            result = net(source, template)
+        for i, level in enumerate(result['levels']):
+            print("{:>8} {:>8} {:>12.1f} {:>14.1f} {:>10}".format(
+                N, i, level['sample_ms'], level['register_ms'], level['num_points']))
+
+
+if __name__ == '__main__':
+    main()
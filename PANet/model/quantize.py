@@ -0,0 +1,176 @@
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import (QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, quantize_dynamic,
+                                   fuse_modules)
+from PANet import PANet, LAGNet
+from export import fold_batchnorm
+from ops import metrics
+from ops.transform_functions import PCRNetTransform
+
+# Int8 推理 (CPU):
+#   dynamic: 回归头 self.fc 的 nn.Linear 动态量化 (权重 int8, 激活在运行时量化)
+#   static : BN 折叠后把 conv + ReLU 融合 (fuse_modules), 量化边界放在整段连续卷积的两端, 段内激活保持 int8:
+#              - LAGNet 主干 conv2d_1 -> conv2d_4: 只在 conv2d_1 前量化, 各阶段的 max 直接在 int8 上取,
+#                只有 (B, C, N) 的 max 结果在进入 PointAttention 前反量化;
+#              - PointAttention 的 fcn_1 / fcn_2 (conv+ReLU -> conv) 与 conv1d_5 (+ReLU) 各为一段.
+#            在合成点云上校准激活的量化参数. gather / softmax / 融合加权等仍是 fp32.
+#            project_first 模式下 conv2d_1 只提供权重给 project_points, 保持 fp32, 从 conv2d_2 开始量化.
+# 报告各方案相对 fp32 的延迟以及旋转/平移误差 (相对真值, 以及相对 fp32 输出的偏差).
+#   python quantize.py --checkpoint best_model.t7 --calib_batches 8
+
+
+def _engine():
+    engines = torch.backends.quantized.supported_engines
+    for name in ('x86', 'fbgemm', 'qnnpack'):
+        if name in engines:
+            return name
+    raise RuntimeError("no quantized engine available: {}".format(engines))
+
+
+class DequantizedInputs(nn.Module):
+    # 量化段的出口: 把 int8 输入反量化后交给 fp32 模块 (PointAttention)
+    def __init__(self, module):
+        super(DequantizedInputs, self).__init__()
+        self.module = module
+        self.dequant = DeQuantStub()
+
+    def forward(self, *inputs):
+        return self.module(*[self.dequant(x) for x in inputs])
+
+
+def _conv_relu(conv):
+    # 折叠后的 conv 与其后的 ReLU 融合成一个模块 (ConvReLU1d / ConvReLU2d)
+    return fuse_modules(nn.Sequential(conv, nn.ReLU()), [['0', '1']])[0]
+
+
+def _quantize_stages(feature_model: LAGNet, qconfig):
+    # 折叠后的 conv 换成融合的 conv+ReLU, 量化 / 反量化 stub 只放在每段连续卷积的两端 (见文件头)
+    blocks = []
+    first = 2 if feature_model.project_first else 1
+    for k in range(first, 5):
+        block = _conv_relu(getattr(feature_model, 'conv2d_{}'.format(k)))
+        if k == first:
+            block = nn.Sequential(QuantStub(), block)
+        setattr(feature_model, 'conv2d_{}'.format(k), block)
+        blocks.append(block)
+    for k in range(1, 5):
+        pa_layer = getattr(feature_model, 'pa_layer{}'.format(k))
+        for name in ('fcn_1', 'fcn_2'):
+            fcn = getattr(pa_layer, name)    # [conv, Identity (BN), ReLU, conv, Identity (BN)]
+            fuse_modules(fcn, [['0', '2']], inplace=True)
+            block = nn.Sequential(QuantStub(), *fcn, DeQuantStub())
+            setattr(pa_layer, name, block)
+            blocks.append(block)
+        if k >= first:
+            wrapper = DequantizedInputs(pa_layer)
+            blocks.append(wrapper.dequant)  # 只给出口 stub 设 qconfig, fcn_3 等未使用的层保持 fp32
+            setattr(feature_model, 'pa_layer{}'.format(k), wrapper)
+    feature_model.conv1d_5 = nn.Sequential(QuantStub(), _conv_relu(feature_model.conv1d_5), DeQuantStub())
+    blocks.append(feature_model.conv1d_5)
+    for block in blocks:
+        block.qconfig = qconfig
+
+
+def quantize_head_dynamic(model: PANet):
+    # 回归头的 nn.Linear 动态量化 (原地)
+    model.fc = quantize_dynamic(model.fc, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def quantize_convs_static(model: PANet, calibration, num_iter=4):
+    # feature_model (LAGNet) 的 1x1 卷积静态量化 (原地); calibration: 用于校准激活范围的 (source, template) batch
+    torch.backends.quantized.engine = _engine()
+    qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    model = fold_batchnorm(model.eval())
+    feature_model = model.feature_model
+    # Workspace 的 out= 缓冲区是 fp32, 而主干的激活现在是 int8
+    feature_model.use_workspace = False
+    _quantize_stages(feature_model, qconfig)
+    prepare(feature_model, inplace=True)
+    with torch.no_grad():
+        for source, template in calibration:
+            model(source, template, num_iter=num_iter)
+    convert(feature_model, inplace=True)
+    return model
+
+
+def build(mode, base: PANet, calibration, num_iter=4):
+    # mode: 'fp32' | 'dynamic' | 'static' | 'dynamic+static', 返回 base 的量化副本
+    model = copy.deepcopy(base).eval()
+    if 'static' in mode:
+        quantize_convs_static(model, calibration, num_iter)
+    if 'dynamic' in mode:
+        quantize_head_dynamic(model)
+    return model
+
+
+def make_pairs(num_batches, batch_size, num_points, seed=0):
+    # 合成 (source, template, igt): source = igt(template), igt 取自 PCRNetTransform 的变换
+    generator = torch.Generator().manual_seed(seed)
+    bank = PCRNetTransform(num_batches * batch_size, rng=seed)
+    pairs = []
+    for i in range(num_batches):
+        template = torch.rand(batch_size, num_points, 3, generator=generator) - 0.5
+        source, gt_quat, gt_trans, _ = bank(template, torch.arange(i * batch_size, (i + 1) * batch_size))
+        pairs.append((source, template, torch.cat((gt_quat, gt_trans), dim=1)))
+    return pairs
+
+
+def evaluate(model, pairs, num_iter=4, repeat=3):
+    # 返回每次前向的延迟 (ms), 相对真值的 RegistrationMeter 统计, 以及所有 pair 的预测位姿
+    latencies, poses = [], []
+    meter = metrics.RegistrationMeter()
+    with torch.no_grad():
+        model(pairs[0][0], pairs[0][1], num_iter=num_iter)
+        for source, template, igt in pairs:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = model(source, template, num_iter=num_iter)
+                latencies.append(time.perf_counter() - start)
+            meter.update(result['pose_pred'], igt)
+            poses.append(result['pose_pred'])
+    return np.array(latencies) * 1e3, meter.compute(), torch.cat(poses)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default=None, help='state_dict of PANet')
+    parser.add_argument('--modes', nargs='+', default=['fp32', 'dynamic', 'static', 'dynamic+static'])
+    parser.add_argument('--project_first', action='store_true')
+    parser.add_argument('--num_iter', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--calib_batches', type=int, default=8)
+    parser.add_argument('--test_batches', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    base = PANet(feature_model=LAGNet(project_first=args.project_first))
+    if args.checkpoint is not None:
+        base.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    base.eval()
+    # 校准集和测试集用不同的随机种子
+    calibration = [pair[:2] for pair in make_pairs(args.calib_batches, args.batch_size, args.num_points, seed=1)]
+    test = make_pairs(args.test_batches, args.batch_size, args.num_points, seed=2)
+
+    print("{:>16} {:>10} {:>10} {:>12} {:>12} {:>14} {:>14}".format(
+        'mode', 'p50(ms)', 'speedup', 'rot_err(deg)', 'trans_err', 'd_rot vs fp32', 'd_trans vs fp32'))
+    reference, base_p50 = None, None
+    for mode in args.modes:
+        model = build(mode, base, calibration, args.num_iter)
+        latencies, summary, poses = evaluate(model, test, args.num_iter, args.repeat)
+        p50 = float(np.percentile(latencies, 50))
+        if reference is None:
+            reference, base_p50 = poses, p50
+        drift = metrics.registration_errors(poses, reference)
+        print("{:>16} {:>10.2f} {:>9.2f}x {:>12.4f} {:>12.5f} {:>14.4f} {:>14.5f}".format(
+            mode, p50, base_p50 / p50, summary['rot_iso_mae'], summary['trans_iso_mae'],
+            drift['rot_iso'].mean().item(), drift['trans_iso'].mean().item()))
+
+
+if __name__ == '__main__':
+    main()
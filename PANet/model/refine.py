@@ -0,0 +1,93 @@
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from PANet import PANet
+from ops import icp, metrics, pose
+from quantize import make_pairs
+
+# Learned init + ICP refinement.
+# PANet 先跑少量迭代给出初始位姿, 再用批量 point-to-point ICP (ops/icp.py) 精修.
+# ICP 每次迭代只有一次最近邻查询和一个 3x3 SVD, 远比再跑一遍 LAGNet 便宜.
+#   python refine.py --checkpoint best_model.t7 --num_iters 4 8 12 --icp_iters 5 10 20
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class RefinedPANet(nn.Module):
+    def __init__(self, model: PANet, num_iter=4, icp_iter=10, max_dist=None, tol=1e-6, backend='auto'):
+        """
+        num_iter: PANet iterations for the initial pose. icp_iter: maximum ICP iterations (0 disables ICP).
+        max_dist / tol / backend: see ops.icp.icp.
+        """
+        super(RefinedPANet, self).__init__()
+        self.model = model
+        self.num_iter = num_iter
+        self.icp_iter = icp_iter
+        self.max_dist = max_dist
+        self.tol = tol
+        self.backend = backend
+
+    def forward(self, source, template):
+        start = time.perf_counter()
+        result = self.model(source, template, num_iter=self.num_iter)
+        _sync(source.device)
+        network_ms = (time.perf_counter() - start) * 1e3
+        timing = {'network_ms': network_ms, 'correspondence_ms': 0.0, 'solve_ms': 0.0}
+        if self.icp_iter == 0:
+            return dict(result, timing=timing, icp_iter=0)
+        refined = icp.icp(source, template, result['pose_pred'], self.icp_iter, self.max_dist, self.tol, self.backend)
+        timing.update(refined['timing'])
+        return {'pose_pred': refined['pose_pred'],
+                'transform_pred': pose.pose_to_transform(refined['pose_pred']),
+                'transformed_template': refined['transformed_template'],
+                'network_pose': result['pose_pred'],
+                'icp_iter': refined['num_iter'],
+                'timing': timing}
+
+
+def main():
+    # 精度 / 毫秒: 只增加网络迭代次数 vs 网络 + ICP
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default=None, help='state_dict of PANet')
+    parser.add_argument('--num_iters', type=int, nargs='+', default=[4, 8, 12])
+    parser.add_argument('--icp_iters', type=int, nargs='+', default=[5, 10, 20])
+    parser.add_argument('--init_iter', type=int, default=4, help='PANet iterations before ICP')
+    parser.add_argument('--max_dist', type=float, default=None)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--num_batches', type=int, default=4)
+    args = parser.parse_args()
+
+    model = PANet()
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model.eval()
+    pairs = make_pairs(args.num_batches, args.batch_size, args.num_points)
+    configs = [(n, 0) for n in args.num_iters] + [(args.init_iter, k) for k in args.icp_iters]
+
+    print("{:>6} {:>5} {:>10} {:>12} {:>10} {:>10} {:>12} {:>12}".format(
+        'iter', 'icp', 'total(ms)', 'network(ms)', 'nn(ms)', 'svd(ms)', 'rot_err(deg)', 'trans_err'))
+    with torch.no_grad():
+        for num_iter, icp_iter in configs:
+            net = RefinedPANet(model, num_iter, icp_iter, args.max_dist)
+            net(*pairs[0][:2])      # warmup
+            meter = metrics.RegistrationMeter()
+            timings = []
+            for source, template, igt in pairs:
+                result = net(source, template)
+                meter.update(result['pose_pred'], igt)
+                timings.append(result['timing'])
+            summary = meter.compute()
+            mean = {key: float(np.mean([t[key] for t in timings])) for key in timings[0]}
+            print("{:>6} {:>5} {:>10.1f} {:>12.1f} {:>10.1f} {:>10.1f} {:>12.4f} {:>12.5f}".format(
+                num_iter, icp_iter, sum(mean.values()), mean['network_ms'], mean['correspondence_ms'],
+                mean['solve_ms'], summary['rot_iso_mae'], summary['trans_iso_mae']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import json
+import time
+import asyncio
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PANet import PANet, LAGNet
+
+# 本地配准服务: asyncio HTTP (TCP 或 Unix socket), 只用标准库.
+#   POST /register  {"source": [[x, y, z], ...], "template": [[x, y, z], ...]}
+#                   -> {"pose": [qw, qx, qy, qz, tx, ty, tz], "transform": 3x4, "batch_size": n, "latency_ms": t}
+#   GET  /metrics   -> 队列深度, batch 大小直方图, 延迟分位数
+# 请求按 (source 点数, template 点数) 分组拼成动态 batch: 某组攒满 max_batch 立即执行,
+# 否则等第一个请求到达后 max_wait 秒再执行. PANet.forward 在单独的工作线程上运行, 不阻塞事件循环.
+#   python server.py --port 8600 --max_batch 16 --max_wait 0.005 [--checkpoint best_model.t7]
+
+
+class Metrics:
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes = collections.Counter()
+        self.latency = collections.deque(maxlen=window)        # 请求到达 -> 结果返回 (ms)
+        self.queue_wait = collections.deque(maxlen=window)     # 请求到达 -> 工作线程开始 forward (ms)
+        self.compute = collections.deque(maxlen=window)        # 每个 batch 的 forward 时间 (ms)
+
+    @staticmethod
+    def _quantiles(values):
+        if not values:
+            return None
+        values = np.fromiter(values, dtype=np.float64)
+        return {'p50': float(np.percentile(values, 50)), 'p99': float(np.percentile(values, 99)),
+                'mean': float(values.mean())}
+
+    def snapshot(self, queue_depth, in_flight):
+        return {'requests': self.requests, 'batches': self.batches, 'errors': self.errors,
+                'queue_depth': queue_depth, 'in_flight_batches': in_flight,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'latency_ms': self._quantiles(self.latency),
+                'queue_wait_ms': self._quantiles(self.queue_wait),
+                'batch_compute_ms': self._quantiles(self.compute)}
+
+
+class DynamicBatcher:
+    """
+    Groups concurrent requests with the same point counts into one batched PANet.forward.
+    """
+    def __init__(self, model, num_iter=4, max_batch=16, max_wait=0.005):
+        self.model = model
+        self.num_iter = num_iter
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = Metrics()
+        self.pending = collections.defaultdict(list)     # key -> [(source, template, future, t_arrive)]
+        self.timers = {}
+        self.in_flight = 0
+        # 只用一个工作线程: forward 内部已经用 intra-op 线程并行, batch 之间串行执行
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='panet')
+
+    def queue_depth(self):
+        return sum(len(items) for items in self.pending.values())
+
+    async def submit(self, source, template):
+        loop = asyncio.get_running_loop()
+        key = (source.shape[0], template.shape[0])
+        future = loop.create_future()
+        self.pending[key].append((source, template, future, time.perf_counter()))
+        self.metrics.requests += 1
+        if len(self.pending[key]) >= self.max_batch:
+            self._flush(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        items = self.pending.pop(key, [])
+        while items:
+            batch, items = items[:self.max_batch], items[self.max_batch:]
+            asyncio.ensure_future(self._run(batch))
+
+    def _forward(self, source, template):
+        start = time.perf_counter()
+        with torch.no_grad():
+            result = self.model(source, template, num_iter=self.num_iter)
+        return result['pose_pred'], result['transform_pred'], start
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        source = torch.stack([item[0] for item in batch])
+        template = torch.stack([item[1] for item in batch])
+        self.in_flight += 1
+        try:
+            poses, transforms, started = await loop.run_in_executor(self.executor, self._forward, source, template)
+        except Exception as e:
+            self.metrics.errors += len(batch)
+            for item in batch:
+                if not item[2].done():
+                    item[2].set_exception(e)
+            return
+        finally:
+            self.in_flight -= 1
+        done = time.perf_counter()
+        self.metrics.batches += 1
+        self.metrics.batch_sizes[len(batch)] += 1
+        self.metrics.compute.append((done - started) * 1e3)
+        poses, transforms = poses.tolist(), transforms.tolist()
+        for i, (_, _, future, arrived) in enumerate(batch):
+            self.metrics.queue_wait.append((started - arrived) * 1e3)
+            self.metrics.latency.append((done - arrived) * 1e3)
+            if not future.done():
+                future.set_result({'pose': poses[i], 'transform': transforms[i], 'batch_size': len(batch),
+                                   'latency_ms': (done - arrived) * 1e3})
+
+
+class RegistrationServer:
+    # 极简 HTTP/1.1 (支持 keep-alive), 只处理上面两个路由
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def _respond(self, writer, status, body, keep_alive):
+        payload = json.dumps(body).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+        header = "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+            status, reason, len(payload), 'keep-alive' if keep_alive else 'close')
+        writer.write(header.encode() + payload)
+        await writer.drain()
+
+    def _validate(self, source, template):
+        # 在进入 batch 之前拒绝无效点云, 否则 kNN (topk) 会在 batch 内失败, 连带同一 batch 的其它请求
+        k = getattr(self.batcher.model.feature_model, 'nbrs_num1', 1)
+        for name, cloud in (('source', source), ('template', template)):
+            if cloud.dim() != 2 or cloud.shape[1] != 3:
+                return '{} must be a list of [x, y, z] points, got shape {}'.format(name, list(cloud.shape))
+            if cloud.shape[0] < k:
+                return '{} has {} points, at least {} (the kNN size) are required'.format(name, cloud.shape[0], k)
+            if not torch.isfinite(cloud).all():
+                return '{} contains NaN or Inf'.format(name)
+        return None
+
+    async def _handle_request(self, method, path, body):
+        if method == 'GET' and path == '/metrics':
+            return 200, self.batcher.metrics.snapshot(self.batcher.queue_depth(), self.batcher.in_flight)
+        if method == 'POST' and path == '/register':
+            try:
+                request = json.loads(body)
+                source = torch.tensor(request['source'], dtype=torch.float32)
+                template = torch.tensor(request['template'], dtype=torch.float32)
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {'error': 'invalid request: {}'.format(e)}
+            error = self._validate(source, template)
+            if error is not None:
+                return 400, {'error': error}
+            try:
+                return 200, await self.batcher.submit(source, template)
+            except Exception as e:
+                return 500, {'error': str(e)}
+        return 404, {'error': 'unknown route {} {}'.format(method, path)}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, sep, value = line.decode('latin-1').partition(':')
+                        if not sep:
+                            raise ValueError('malformed header line {!r}'.format(line[:80]))
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError('negative Content-Length')
+                except ValueError as e:
+                    # 请求行 / 头部无法解析: 回 400 后关闭连接 (无法确定下一个请求从哪里开始)
+                    await self._respond(writer, 400, {'error': 'malformed request: {}'.format(e)}, False)
+                    break
+                body = await reader.readexactly(length)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                status, response = await self._handle_request(method, path, body)
+                await self._respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8600, unix_path=None):
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--unix', default=None, help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--checkpoint', default=None, help='state_dict of PANet')
+    parser.add_argument('--num_iter', type=int, default=4)
+    parser.add_argument('--max_batch', type=int, default=16)
+    parser.add_argument('--max_wait', type=float, default=0.005, help='seconds')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = PANet(feature_model=LAGNet())
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model.eval()
+    batcher = DynamicBatcher(model, args.num_iter, args.max_batch, args.max_wait)
+    asyncio.run(RegistrationServer(batcher).serve(args.host, args.port, args.unix))
+
+
+if __name__ == '__main__':
+    main()
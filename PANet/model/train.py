@@ -0,0 +1,213 @@
+import os
+import time
+import socket
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
+from PANet import PANet, LAGNet
+from ops import pose
+from ops.augment import AugmentCollate, partial_registration_pipeline
+from ops.cloud_io import PackedClouds
+from ops.transform_functions import PCRNetTransform
+
+# CPU 数据并行训练: DistributedDataParallel + gloo, 每个进程一份模型.
+# 数据集第 i 个样本固定使用变换库 (PCRNetTransform) 的第 i % len(bank) 行, DistributedSampler 按下标切分,
+# 所以各 rank 拿到的是变换库互不相交的分片. 每个 rank 的 intra-op 线程数默认为 核数 / 进程数.
+#   单机多进程:  python train.py --nprocs 4 --data clouds.pack --bank bank.npy
+#   多机:        torchrun --nnodes 2 --nproc_per_node 4 --rdzv_endpoint host:29500 train.py --data ...
+#   扩展效率:    python train.py --scaling 1 2 4 --max_steps 20
+
+
+class SyntheticClouds(Dataset):
+    # 没有 --data 时使用的随机点云, 样本格式与 PackedClouds 相同: (cloud, bank 下标)
+    def __init__(self, size, num_points, bank_size, seed=0):
+        rng = np.random.default_rng(seed)
+        self.clouds = rng.random((size, num_points, 3), dtype=np.float32) - 0.5
+        self.bank_size = bank_size
+
+    def __len__(self):
+        return len(self.clouds)
+
+    def __getitem__(self, index):
+        return self.clouds[index], index % self.bank_size
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def registration_loss(result, batch):
+    # template 在真值位姿下的位置作为目标 (补上的离群点也按同一位姿移动)
+    target = pose.transform_points(batch['igt'], batch['template'])
+    return F.mse_loss(result['transformed_template'], target)
+
+
+def build_loader(args, rank, world_size):
+    if args.bank is not None:
+        # 是否生成只由 rank 0 判断, 所有 rank 都经过这个 barrier, 之后再映射同一个 (已完整写出的) 文件
+        if rank == 0 and not os.path.exists(args.bank):
+            PCRNetTransform(args.dataset_size, rng=args.seed, path=args.bank)
+        dist.barrier()
+    bank = PCRNetTransform(args.dataset_size, rng=args.seed, path=args.bank)
+    if args.data is not None:
+        dataset = PackedClouds(args.data, bank_size=len(bank))
+    else:
+        dataset = SyntheticClouds(args.dataset_size, args.num_points, len(bank), seed=args.seed)
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True,
+                                 seed=args.seed, drop_last=True)
+    # 每个 rank 的增强用不同的随机流
+    collate = AugmentCollate(partial_registration_pipeline(bank, args.partial_points, seed=args.seed + 1000 * rank))
+    loader = DataLoader(dataset, args.batch_size, sampler=sampler, num_workers=args.num_workers,
+                        collate_fn=collate, drop_last=True, persistent_workers=args.num_workers > 0)
+    return loader, sampler
+
+
+def train(rank, world_size, args, results=None):
+    local_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))     # 本机上的进程数
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // local_size))
+    torch.manual_seed(args.seed)    # 各 rank 初始权重相同 (DDP 构造时也会从 rank 0 广播)
+    model = PANet(feature_model=LAGNet(project_first=args.project_first, checkpoint_stages=args.checkpoint_stages))
+    # 未参与前向的层 (conv1d_1~4, pa_layer*.fcn_3 等) 没有梯度, 需要 find_unused_parameters;
+    # static_graph 可以省掉每步的图遍历, 但不能在第一步之前用 no_sync (梯度累积)
+    ddp = DistributedDataParallel(model, find_unused_parameters=True)
+    optimizer = torch.optim.Adam(ddp.parameters(), lr=args.lr)
+    loader, sampler = build_loader(args, rank, world_size)
+
+    step, samples, start, data_time, compute_time = 0, 0, None, 0.0, 0.0
+    done = False
+    for epoch in range(args.epochs):
+        sampler.set_epoch(epoch)
+        ddp.train()
+        optimizer.zero_grad(set_to_none=True)
+        t_data = time.perf_counter()
+        for micro, batch in enumerate(loader):
+            t_compute = time.perf_counter()
+            # 梯度累积: 前 accum_steps - 1 个 micro-batch 不做 allreduce
+            last = (micro + 1) % args.accum_steps == 0
+            if last:
+                loss = registration_loss(ddp(batch['source'], batch['template'], num_iter=args.num_iter), batch)
+                (loss / args.accum_steps).backward()
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+                step += 1
+            else:
+                with ddp.no_sync():
+                    loss = registration_loss(ddp(batch['source'], batch['template'], num_iter=args.num_iter), batch)
+                    (loss / args.accum_steps).backward()
+            now = time.perf_counter()
+
+            # 前 warmup 个优化步不计入吞吐
+            if step > args.warmup or (step == args.warmup and last):
+                if start is None:
+                    start = now
+                else:
+                    samples += batch['source'].shape[0]
+                    data_time += t_compute - t_data
+                    compute_time += now - t_compute
+            if last and step % args.log_every == 0 and start is not None and samples > 0:
+                print("[rank {}/{}] epoch {} step {} loss {:.5f} {:.1f} samples/s (data {:.0f}%)".format(
+                    rank, world_size, epoch, step, loss.item(), samples / (now - start),
+                    100 * data_time / max(now - start, 1e-9)), flush=True)
+            if args.max_steps is not None and step >= args.max_steps and last:
+                done = True
+                break
+            t_data = time.perf_counter()
+        if done:
+            break
+
+    elapsed = (time.perf_counter() - start) if start is not None else 0.0
+    stats = {'rank': rank, 'samples': samples, 'elapsed': elapsed,
+             'samples_per_s': samples / elapsed if elapsed > 0 else 0.0,
+             'data_s': data_time, 'compute_s': compute_time}
+    gathered = [None] * world_size
+    dist.all_gather_object(gathered, stats)
+    if rank == 0:
+        for s in gathered:
+            print("[rank {}] {} samples in {:.1f} s: {:.2f} samples/s (data {:.1f} s, compute {:.1f} s)".format(
+                s['rank'], s['samples'], s['elapsed'], s['samples_per_s'], s['data_s'], s['compute_s']))
+        total = sum(s['samples_per_s'] for s in gathered)
+        print("world size {}: {:.2f} samples/s total".format(world_size, total))
+        if args.save is not None:
+            torch.save(model.state_dict(), args.save)
+        if results is not None:
+            results.put((world_size, total))
+    return stats
+
+
+def _worker(local_rank, world_size, args, port, results):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(port))
+    dist.init_process_group('gloo', rank=local_rank, world_size=world_size)
+    try:
+        train(local_rank, world_size, args, results)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(nprocs, args, results=None):
+    # 本机多进程; 每次启动用新的端口, 便于 --scaling 连续启动多组
+    mp.spawn(_worker, args=(nprocs, args, _free_port(), results), nprocs=nprocs, join=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default=None, help='point cloud pack (ops/cloud_io.py); synthetic clouds if omitted')
+    parser.add_argument('--bank', default=None, help='.npy transform bank, created if missing')
+    parser.add_argument('--dataset_size', type=int, default=1024, help='transform bank size (and synthetic dataset size)')
+    parser.add_argument('--num_points', type=int, default=1024, help='points per synthetic cloud')
+    parser.add_argument('--partial_points', type=int, default=768)
+    parser.add_argument('--batch_size', type=int, default=8, help='per rank and micro-batch')
+    parser.add_argument('--accum_steps', type=int, default=1, help='micro-batches per optimizer step')
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--max_steps', type=int, default=None, help='optimizer steps per rank')
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--num_iter', type=int, default=4)
+    parser.add_argument('--project_first', action='store_true')
+    parser.add_argument('--checkpoint_stages', action='store_true')
+    parser.add_argument('--num_workers', type=int, default=0, help='DataLoader workers per rank')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads per rank (default cores / ranks)')
+    parser.add_argument('--warmup', type=int, default=1, help='optimizer steps excluded from throughput')
+    parser.add_argument('--log_every', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', default=None, help='write the trained state_dict here (rank 0)')
+    parser.add_argument('--nprocs', type=int, default=1, help='local processes when not started by torchrun')
+    parser.add_argument('--scaling', type=int, nargs='+', default=None,
+                        help='measure throughput and scaling efficiency for these process counts')
+    args = parser.parse_args()
+
+    if args.scaling is not None:
+        if args.max_steps is None:
+            args.max_steps = 20
+        queue = mp.get_context('spawn').SimpleQueue()
+        throughput = {}
+        for nprocs in args.scaling:
+            launch(nprocs, args, queue)
+            world_size, total = queue.get()
+            throughput[world_size] = total
+        base_n = args.scaling[0]
+        base = throughput[base_n] / base_n
+        print("{:>6} {:>12} {:>10} {:>11}".format('procs', 'samples/s', 'speedup', 'efficiency'))
+        for n in args.scaling:
+            print("{:>6} {:>12.2f} {:>9.2f}x {:>10.0f}%".format(
+                n, throughput[n], throughput[n] / throughput[base_n], 100 * throughput[n] / (n * base)))
+    elif 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        # torchrun (单机或多机): 环境变量里已有 rank / world size / master 地址
+        dist.init_process_group('gloo')
+        try:
+            train(dist.get_rank(), dist.get_world_size(), args)
+        finally:
+            dist.destroy_process_group()
+    else:
+        launch(args.nprocs, args)
+
+
+if __name__ == '__main__':
+    main()